@@ -2,19 +2,127 @@
 """
 Simple HTTP proxy for AntiGravity API
 """
+import argparse
+import ast
+import contextlib
 import http.server
+import importlib.util
+import io
 import json
 import os
+import runpy
+import signal
+import socket
 import socketserver
-import subprocess
 import sys
+import threading
+import time
 import urllib.parse
 import urllib.request
 
+DEFAULT_HELPER = '/home/.local/bin/antigravity_helper.py'
+DEFAULT_PORT = 8123
+DEFAULT_IDLE_MINUTES = 30
+DEFAULT_MAX_BODY_MB = 32
+MB = 1024 * 1024
+RUN_DIR = os.path.expanduser("~/.config/claude-all/antigravity")
+
+_helper_lock = threading.Lock()
+_helper_module = None
+
+
+def helper_defines_chat(path):
+    """True if the helper source has a top-level chat() function, checked without running it."""
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read(), filename=path)
+    return any(isinstance(node, ast.FunctionDef) and node.name == 'chat' for node in tree.body)
+
+
+def load_helper(path):
+    """Import a helper that defines chat() once and keep it; None for CLI-only helpers.
+
+    CLI-only helpers are never imported, as their module body may read
+    sys.argv and would see the proxy's arguments. Import errors propagate
+    and the import is tried again on the next request.
+    """
+    global _helper_module
+    with _helper_lock:
+        if _helper_module is None:
+            if not helper_defines_chat(path):
+                _helper_module = False
+            else:
+                spec = importlib.util.spec_from_file_location('antigravity_helper', path)
+                if spec is None or spec.loader is None:
+                    raise ImportError(f"Cannot load helper: {path}")
+                module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(module)
+                _helper_module = module
+        return _helper_module or None
+
+
+def run_helper_chat(helper_path, auth_file, model, messages):
+    """Run the helper's chat command in-process and return its JSON response text.
+
+    Helpers exposing chat(auth_file, model, messages) are called directly.
+    Older CLI-only helpers are executed as __main__ with the usual argv, with
+    stdout captured; this still avoids an interpreter start per request and
+    the OS limit on argv size.
+    """
+    module = load_helper(helper_path)
+    chat = getattr(module, 'chat', None) if module is not None else None
+    if callable(chat):
+        result = chat(auth_file, model, messages)
+        return result if isinstance(result, str) else json.dumps(result)
+
+    stdout, stderr = io.StringIO(), io.StringIO()
+    # sys.argv and stdout are process-wide, so CLI-style calls run one at a time
+    with _helper_lock:
+        saved_argv = sys.argv
+        sys.argv = [helper_path, 'chat', auth_file, model, json.dumps(messages)]
+        try:
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                runpy.run_path(helper_path, run_name='__main__')
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                raise RuntimeError(stderr.getvalue() or f"Helper exited with status {e.code}")
+        finally:
+            sys.argv = saved_argv
+    return stdout.getvalue()
+
+
+def read_body(rfile, length):
+    """Read exactly length bytes into one preallocated buffer that json.loads parses directly."""
+    body = bytearray(length)
+    view = memoryview(body)
+    received = 0
+    while received < length:
+        n = rfile.readinto(view[received:])
+        if not n:
+            raise ConnectionError(f"Client closed the connection after {received} of {length} body bytes")
+        received += n
+    view.release()
+    return body
+
+
 class ProxyHandler(http.server.BaseHTTPRequestHandler):
     def do_POST(self):
-        content_length = int(self.headers.get('Content-Length', 0))
-        post_data = self.rfile.read(content_length)
+        self.server.last_activity = time.monotonic()
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            content_length = -1
+        if content_length < 0:
+            self.send_error_json(400, "Invalid Content-Length")
+            return
+        max_body_size = self.server.max_body_size
+        if max_body_size and content_length > max_body_size:
+            self.send_error_json(413, f"Request body of {content_length} bytes exceeds the "
+                                      f"{max_body_size // MB} MB limit")
+            return
+        try:
+            post_data = read_body(self.rfile, content_length)
+        except ConnectionError:
+            return
 
         # Set CORS headers
         self.send_response(200)
@@ -26,29 +134,17 @@ class ProxyHandler(http.server.BaseHTTPRequestHandler):
         if self.path == '/v1/messages':
             # Parse the request
             try:
-                request_data = json.loads(post_data.decode())
+                request_data = json.loads(post_data)
                 messages = request_data.get('messages', [])
                 model = request_data.get('model', 'gemini-2.0-flash-exp')
 
-                # Call antigravity helper
-                result = subprocess.run([
-                    sys.executable,
-                    sys.argv[1] if len(sys.argv) > 1 else '/home/.local/bin/antigravity_helper.py',
-                    'chat',
-                    sys.argv[2] if len(sys.argv) > 2 else os.environ.get('ANTIGRAVITY_AUTH_FILE', ''),
+                # Call antigravity helper in-process
+                response = run_helper_chat(
+                    self.server.helper_path,
+                    self.server.auth_file,
                     model,
-                    json.dumps(messages)
-                ], capture_output=True, text=True)
-
-                if result.returncode == 0:
-                    response = result.stdout
-                else:
-                    response = json.dumps({
-                        'error': {
-                            'type': 'api_error',
-                            'message': result.stderr or 'Unknown error'
-                        }
-                    })
+                    messages
+                )
             except Exception as e:
                 response = json.dumps({
                     'error': {
@@ -59,6 +155,17 @@ class ProxyHandler(http.server.BaseHTTPRequestHandler):
 
             self.wfile.write(response.encode())
 
+    def send_error_json(self, status, message):
+        # The body is left unread, so the connection is closed after replying
+        body = json.dumps({'error': {'type': 'api_error', 'message': message}}).encode()
+        self.send_response(status)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_OPTIONS(self):
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
@@ -70,9 +177,124 @@ class ProxyHandler(http.server.BaseHTTPRequestHandler):
         # Suppress log messages
         pass
 
+class ProxyServer(socketserver.TCPServer):
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, helper_path, auth_file,
+                 max_body_size=DEFAULT_MAX_BODY_MB * MB):
+        super().__init__(server_address, handler_class)
+        self.helper_path = helper_path
+        self.auth_file = auth_file
+        self.max_body_size = max_body_size
+        self.last_activity = time.monotonic()
+
+
+def read_running_proxy(run_dir):
+    """Return (pid, port) of a live proxy recorded in run_dir, or None."""
+    try:
+        with open(os.path.join(run_dir, 'proxy.pid')) as f:
+            pid = int(f.read().strip())
+        with open(os.path.join(run_dir, 'proxy.port')) as f:
+            port = int(f.read().strip())
+        os.kill(pid, 0)
+        with socket.create_connection(('127.0.0.1', port), timeout=1):
+            pass
+    except (OSError, ValueError):
+        return None
+    return pid, port
+
+
+def write_run_files(run_dir, port):
+    os.makedirs(run_dir, exist_ok=True)
+    for name, value in (('proxy.pid', os.getpid()), ('proxy.port', port)):
+        tmp_path = os.path.join(run_dir, f'.{name}.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write(f"{value}\n")
+        os.replace(tmp_path, os.path.join(run_dir, name))
+
+
+def remove_run_files(run_dir):
+    # Only clean up files that still describe this process
+    pid_file = os.path.join(run_dir, 'proxy.pid')
+    try:
+        with open(pid_file) as f:
+            if int(f.read().strip()) != os.getpid():
+                return
+    except (OSError, ValueError):
+        return
+    for name in ('proxy.pid', 'proxy.port'):
+        try:
+            os.remove(os.path.join(run_dir, name))
+        except OSError:
+            pass
+
+
+def watch_idle(httpd, idle_seconds, stop_event):
+    """Shut the server down once no request has arrived for idle_seconds."""
+    while not stop_event.wait(min(idle_seconds, 30)):
+        if time.monotonic() - httpd.last_activity >= idle_seconds:
+            print(f"Idle for {idle_seconds // 60} minutes, exiting")
+            httpd.shutdown()
+            return
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Simple HTTP proxy for AntiGravity API")
+    parser.add_argument('helper', nargs='?', default=DEFAULT_HELPER,
+                        help=f"Path to antigravity_helper.py (default: {DEFAULT_HELPER})")
+    parser.add_argument('auth_file', nargs='?', default=os.environ.get('ANTIGRAVITY_AUTH_FILE', ''),
+                        help="Auth file passed to the helper (default: $ANTIGRAVITY_AUTH_FILE)")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help=f"Port to listen on (default: {DEFAULT_PORT})")
+    parser.add_argument('--daemon', action='store_true',
+                        help="Keep serving until stopped or idle instead of exiting after one request")
+    parser.add_argument('--idle-timeout', type=int, default=DEFAULT_IDLE_MINUTES,
+                        help=f"Daemon mode: exit after N idle minutes, 0 to never (default: {DEFAULT_IDLE_MINUTES})")
+    parser.add_argument('--max-body-mb', type=int, default=DEFAULT_MAX_BODY_MB,
+                        help=f"Reject request bodies larger than this with 413, 0 for no limit (default: {DEFAULT_MAX_BODY_MB})")
+    parser.add_argument('--run-dir', default=RUN_DIR,
+                        help=f"Daemon mode: where proxy.pid and proxy.port are written (default: {RUN_DIR})")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.daemon:
+        running = read_running_proxy(args.run_dir)
+        if running:
+            # Reuse the proxy that is already up; launchers read proxy.port
+            print(f"Proxy already running on port {running[1]} (pid {running[0]})")
+            return
+
+    with ProxyServer(("", args.port), ProxyHandler, args.helper, args.auth_file,
+                     args.max_body_mb * MB) as httpd:
+        print(f"Proxy server running on port {args.port}")
+        if not args.daemon:
+            # Serve one request then exit
+            httpd.handle_request()
+            return
+
+        write_run_files(args.run_dir, args.port)
+        stop_event = threading.Event()
+
+        def request_shutdown(signum, frame):
+            # shutdown() blocks until serve_forever returns, so call it off the main thread
+            threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+        signal.signal(signal.SIGTERM, request_shutdown)
+        signal.signal(signal.SIGINT, request_shutdown)
+
+        if args.idle_timeout > 0:
+            threading.Thread(target=watch_idle, args=(httpd, args.idle_timeout * 60, stop_event),
+                             daemon=True).start()
+        try:
+            httpd.serve_forever()
+        finally:
+            stop_event.set()
+            remove_run_files(args.run_dir)
+            print("Proxy server stopped")
+
+
 if __name__ == '__main__':
-    PORT = 8123
-    with socketserver.TCPServer(("", PORT), ProxyHandler) as httpd:
-        print(f"Proxy server running on port {PORT}")
-        # Serve one request then exit
-        httpd.handle_request()
+    main()
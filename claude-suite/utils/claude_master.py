@@ -8,12 +8,48 @@ import signal
 import shutil
 import platform
 import glob
+import hashlib
+import http.client
+import urllib.request
 
 # Constants
 CONFIG_DIR = os.path.expanduser("~/.config/claude-master")
 CONFIG_FILE = os.path.join(CONFIG_DIR, "config.json")
 LITELLM_PORT = 8555
 LITELLM_HOST = f"http://127.0.0.1:{LITELLM_PORT}"
+LITELLM_KEY = "sk-litellm-proxy"
+LITELLM_STATE_FILE = os.path.join(CONFIG_DIR, "litellm.json")
+LITELLM_CONFIG_FILE = os.path.join(CONFIG_DIR, "litellm_config.json")
+LITELLM_LOG_FILE = os.path.join(CONFIG_DIR, "litellm.log")
+LITELLM_START_TIMEOUT = 30
+# Lines uvicorn prints once the proxy accepts connections
+LITELLM_READY_MARKERS = (b"Uvicorn running on", b"Application startup complete")
+PROBE_MIN_DELAY = 0.005
+PROBE_MAX_DELAY = 0.25
+# Provider catalogs: the repo's bin/, then claude-all's model directories
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+CATALOG_DIRS = [os.path.join(REPO_DIR, "bin"), os.path.join(REPO_DIR, "model"),
+                os.path.expanduser("~/.claude-all/models")]
+# LiteLLM route for each catalog (file name -> model prefix, API key variable)
+CATALOG_PROVIDERS = {
+    "openai": ("", "OPENAI_API_KEY"),
+    "gemini": ("gemini/", "GEMINI_API_KEY"),
+    "groq": ("groq/", "GROQ_API_KEY"),
+    "xai": ("xai/", "XAI_API_KEY"),
+    "deepseek": ("deepseek/", "DEEPSEEK_API_KEY"),
+    "mistral": ("mistral/", "MISTRAL_API_KEY"),
+    "moonshot": ("moonshot/", "MOONSHOT_API_KEY"),
+    "openrouter": ("openrouter/", "OPENROUTER_API_KEY"),
+    "perplexity": ("perplexity/", "PERPLEXITYAI_API_KEY"),
+    "cohere": ("cohere_chat/", "COHERE_API_KEY"),
+    "ollama": ("ollama/", None),
+}
+# Catalogs served by the provider's own Anthropic-compatible endpoint (file name -> api_base,
+# API key variable). Router names are "<provider>/<model id>", as GLM's ids are Claude aliases.
+CATALOG_ANTHROPIC_ENDPOINTS = {
+    "minimax": ("https://api.minimax.io/anthropic", "MINIMAX_API_KEY"),
+    "glm": ("https://api.z.ai/api/anthropic", "GLM_API_KEY"),
+}
 CLAUDE_SESSIONS_DIR = os.path.expanduser("~/.claude/sessions") # Standard claude-code session path
 
 # Colors
@@ -110,42 +146,302 @@ def get_ollama_models():
     except:
         return []
 
-def start_litellm(model_name, env_vars={}):
-    """Starts LiteLLM proxy in background"""
-    print(f"{Colors.BLUE}Starting LiteLLM proxy for {model_name}...{Colors.ENDC}")
-    
-    # Kill existing
+def env_fingerprint(env_vars):
+    """Hash each provider variable so the state file never holds raw API keys"""
+    return {name: hashlib.sha256(value.encode()).hexdigest() for name, value in env_vars.items()}
+
+def litellm_alive(timeout=1):
+    try:
+        with urllib.request.urlopen(f"{LITELLM_HOST}/health/liveliness", timeout=timeout) as response:
+            return response.status == 200
+    except (OSError, ValueError):
+        return False
+
+def read_litellm_state(check_health=True):
+    """Return the recorded state of our background LiteLLM proxy if it is still running"""
+    try:
+        with open(LITELLM_STATE_FILE) as f:
+            state = json.load(f)
+        os.kill(state["pid"], 0)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if check_health and not litellm_alive():
+        return None
+    return state
+
+def write_litellm_state(state):
+    ensure_config()
+    tmp_path = LITELLM_STATE_FILE + ".tmp"
+    with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        json.dump(state, f, indent=4)
+    os.replace(tmp_path, LITELLM_STATE_FILE)
+
+def model_entry(model_name, **params):
+    return {"model_name": model_name, "litellm_params": {"model": model_name, **params}}
+
+def read_litellm_config():
+    try:
+        with open(LITELLM_CONFIG_FILE) as f:
+            return json.load(f).get("model_list", [])
+    except (OSError, ValueError, AttributeError):
+        return []
+
+def write_litellm_config(model_list):
+    """Write the router config (JSON is valid YAML for --config); it may hold custom API keys"""
+    ensure_config()
+    config = {
+        "model_list": model_list,
+        "litellm_settings": {"drop_params": True},
+    }
+    tmp_path = LITELLM_CONFIG_FILE + ".tmp"
+    with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        json.dump(config, f, indent=4)
+    os.replace(tmp_path, LITELLM_CONFIG_FILE)
+
+def is_placeholder_key(key):
+    return not key or key.lower().startswith(("your-", "set_your")) or set(key) == {"x"}
+
+def provider_api_key(provider, key_var, config):
+    """API key from the environment, claude_master settings or claude-all's ~/.<provider>_api_key"""
+    key = os.environ.get(key_var) or config.get("api_keys", {}).get(key_var)
+    if key:
+        return key
+    try:
+        with open(os.path.expanduser(f"~/.{provider}_api_key")) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def catalog_model_ids(catalog):
+    if isinstance(catalog.get("models"), list):
+        return [m["id"] for m in catalog["models"] if isinstance(m, dict) and m.get("id")]
+    if isinstance(catalog.get("available_models"), list):
+        return [m for m in catalog["available_models"] if isinstance(m, str)]
+    return [catalog["model"]] if catalog.get("model") else []
+
+def build_router_config(config):
+    """Router entries for every catalog model whose provider has a key; returns (model_list, env_vars)"""
+    model_list, env_vars, seen = [], {}, set()
+    paths = []
+    for directory in CATALOG_DIRS:
+        paths += sorted(glob.glob(os.path.join(directory, "*.json")))
+
+    for path in paths:
+        provider = os.path.splitext(os.path.basename(path))[0]
+        try:
+            with open(path) as f:
+                catalog = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not isinstance(catalog, dict):
+            continue
+
+        entries = []
+        if provider in CATALOG_PROVIDERS:
+            prefix, key_var = CATALOG_PROVIDERS[provider]
+            params = {}
+            if key_var:
+                key = provider_api_key(provider, key_var, config)
+                if not key:
+                    continue
+                env_vars[key_var] = key
+                params["api_key"] = f"os.environ/{key_var}"
+            elif not shutil.which("ollama"):
+                continue
+            for model_id in catalog_model_ids(catalog):
+                name = model_id if model_id.startswith(prefix) else prefix + model_id
+                entries.append(model_entry(name, **params))
+        elif provider in CATALOG_ANTHROPIC_ENDPOINTS:
+            api_base, key_var = CATALOG_ANTHROPIC_ENDPOINTS[provider]
+            key = provider_api_key(provider, key_var, config)
+            if not key:
+                continue
+            env_vars[key_var] = key
+            for model_id in catalog_model_ids(catalog):
+                entry = model_entry(f"{provider}/{model_id}", api_base=api_base, api_key=f"os.environ/{key_var}")
+                entry["litellm_params"]["model"] = f"anthropic/{model_id}"
+                entries.append(entry)
+        elif catalog.get("api_base") and not is_placeholder_key(catalog.get("api_key")):
+            # Custom OpenAI-compatible providers added through claude-all
+            for model_id in catalog_model_ids(catalog):
+                entry = model_entry(model_id, api_base=catalog["api_base"], api_key=catalog["api_key"])
+                entry["litellm_params"]["model"] = f"openai/{model_id}"
+                entries.append(entry)
+
+        for entry in entries:
+            if entry["model_name"] not in seen:
+                seen.add(entry["model_name"])
+                model_list.append(entry)
+    return model_list, env_vars
+
+def add_litellm_model(model_name):
+    """Hot-add a model through the proxy's config API; False if the proxy refuses"""
+    body = json.dumps({"model_name": model_name, "litellm_params": {"model": model_name}}).encode()
+    request = urllib.request.Request(f"{LITELLM_HOST}/model/new", data=body, method="POST",
+                                     headers={"Content-Type": "application/json",
+                                              "Authorization": f"Bearer {LITELLM_KEY}"})
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return 200 <= response.status < 300
+    except (OSError, ValueError):
+        # Proxies without a model database reject /model/new
+        return False
+
+def is_litellm_process(pid):
+    """Whether pid is still a LiteLLM proxy, and not an unrelated process that reused the pid"""
+    try:
+        with open(f"/proc/{pid}/cmdline", 'rb') as f:
+            return b"litellm" in f.read()
+    except FileNotFoundError:
+        if os.path.isdir("/proc/self"):
+            return False
+    except OSError:
+        pass
+    # No /proc (e.g. macOS): trust the pid only if a proxy answers on our port
+    return litellm_alive()
+
+def stop_litellm():
+    """Stop the background proxy started by a previous session, if any"""
+    state = read_litellm_state(check_health=False)
+    if state and not is_litellm_process(state["pid"]):
+        # Stale state file; the pid now belongs to something else
+        state = None
+    if state:
+        try:
+            os.kill(state["pid"], signal.SIGTERM)
+        except OSError:
+            pass
+        # Give it a moment to release the port
+        deadline = time.monotonic() + 3
+        while time.monotonic() < deadline:
+            try:
+                if os.waitpid(state["pid"], os.WNOHANG)[0]:
+                    break
+            except ChildProcessError:
+                pass  # Started by an earlier session, not our child
+            try:
+                os.kill(state["pid"], 0)
+            except OSError:
+                break
+            time.sleep(0.05)
+    try:
+        os.remove(LITELLM_STATE_FILE)
+    except OSError:
+        pass
+    return state is not None
+
+def wait_for_litellm(process, timeout=LITELLM_START_TIMEOUT):
+    """Probe the proxy until it answers; returns the startup time in seconds, or None.
+
+    Probes back off exponentially from a few milliseconds over one reused
+    HTTP connection. The proxy's log is followed as well, and its "ready"
+    line triggers an immediate probe.
+    """
+    started = time.monotonic()
+    deadline = started + timeout
+    delay = PROBE_MIN_DELAY
+    conn = http.client.HTTPConnection("127.0.0.1", LITELLM_PORT, timeout=1)
+    log_tail = b""
+    try:
+        with open(LITELLM_LOG_FILE, 'rb') as log:
+            while time.monotonic() < deadline:
+                if process.poll() is not None:
+                    return None
+                try:
+                    conn.request("GET", "/health/liveliness")
+                    response = conn.getresponse()
+                    response.read()
+                    if response.status == 200:
+                        return time.monotonic() - started
+                except (OSError, http.client.HTTPException):
+                    # Not listening yet; the next request reconnects
+                    conn.close()
+
+                log_tail = log_tail[-256:] + log.read()
+                if any(marker in log_tail for marker in LITELLM_READY_MARKERS):
+                    log_tail = b""
+                    delay = PROBE_MIN_DELAY
+                    continue
+                time.sleep(delay)
+                delay = min(delay * 2, PROBE_MAX_DELAY)
+    finally:
+        conn.close()
+    return None
+
+def start_litellm(model_name, env_vars={}, config=None):
+    """Ensures a LiteLLM proxy serving model_name is running, reusing a warm one when possible
+
+    With config, the proxy is started with a router covering every catalog
+    model that has an API key, so later model switches need no restart.
+    """
+    router_models = []
+    if config is not None:
+        router_models, router_env = build_router_config(config)
+        env_vars = {**router_env, **env_vars}
+    fingerprint = env_fingerprint(env_vars)
+    state = read_litellm_state()
+    compatible = state is not None and all(state.get("env", {}).get(k) == v for k, v in fingerprint.items())
+
+    if compatible:
+        if model_name in state["models"]:
+            print(f"{Colors.GREEN}Reusing running LiteLLM proxy (pid {state['pid']}) for {model_name}{Colors.ENDC}")
+            return state
+        if add_litellm_model(model_name):
+            state["models"].append(model_name)
+            write_litellm_config(read_litellm_config() + [model_entry(model_name)])
+            write_litellm_state(state)
+            print(f"{Colors.GREEN}Added {model_name} to running LiteLLM proxy (pid {state['pid']}){Colors.ENDC}")
+            return state
+
+    # Models the old proxy served stay in the config so switching back is instant
+    model_list, models = [], []
+    for entry in router_models + (read_litellm_config() if compatible else []) + [model_entry(model_name)]:
+        if entry["model_name"] not in models:
+            models.append(entry["model_name"])
+            model_list.append(entry)
+
+    print(f"{Colors.BLUE}Starting LiteLLM proxy for {model_name} ({len(models)} models routed)...{Colors.ENDC}")
+    stop_litellm()
+    # Clear anything else still holding the port, e.g. a proxy from an older version
     subprocess.run(f"fuser -k {LITELLM_PORT}/tcp > /dev/null 2>&1", shell=True)
-    
-    cmd = [sys.executable, "-m", "litellm", "--model", model_name, "--port", str(LITELLM_PORT), "--drop_params"]
-    
+
+    write_litellm_config(model_list)
+    cmd = [sys.executable, "-m", "litellm", "--config", LITELLM_CONFIG_FILE, "--port", str(LITELLM_PORT)]
+
     # Merge current env with new vars
     current_env = os.environ.copy()
     current_env.update(env_vars)
-    
-    process = subprocess.Popen(cmd, env=current_env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    
-    # Wait for health check
+
+    # Own session and log file: the proxy outlives this menu and the chat
+    with open(LITELLM_LOG_FILE, 'w') as log:
+        process = subprocess.Popen(cmd, env=current_env, stdout=log, stderr=subprocess.STDOUT,
+                                   start_new_session=True)
+
     print("Waiting for proxy...", end="", flush=True)
-    for _ in range(15):
-        try:
-            subprocess.check_call(["curl", "-s", f"{LITELLM_HOST}/health"], stdout=subprocess.DEVNULL)
-            print(f" {Colors.GREEN}Ready!{Colors.ENDC}")
-            return process
-        except:
-            time.sleep(1)
-            print(".", end="", flush=True)
-    
-    print(f"\n{Colors.FAIL}LiteLLM failed to start.{Colors.ENDC}")
+    startup_time = wait_for_litellm(process)
+    if startup_time is not None:
+        print(f" {Colors.GREEN}Ready in {startup_time:.2f}s!{Colors.ENDC}")
+        state = {"pid": process.pid, "port": LITELLM_PORT, "env": fingerprint,
+                 "models": models, "started_at": time.time(), "startup_seconds": round(startup_time, 3)}
+        write_litellm_state(state)
+        return state
+
+    print(f"\n{Colors.FAIL}LiteLLM failed to start. See {LITELLM_LOG_FILE}{Colors.ENDC}")
     process.kill()
     return None
 
-def run_claude(proxy_pid=None, session_id=None, system_prompt=None):
-    """Runs the main claude CLI"""
+def claude_env(model_name):
     env = os.environ.copy()
     env["ANTHROPIC_BASE_URL"] = LITELLM_HOST
-    env["ANTHROPIC_API_KEY"] = "sk-litellm-proxy"
-    env["ANTHROPIC_MODEL"] = "claude-3-sonnet-20240229" # Dummy
+    env["ANTHROPIC_API_KEY"] = LITELLM_KEY
+    # The router picks the deployment by model name, background calls included
+    env["ANTHROPIC_MODEL"] = model_name
+    env["ANTHROPIC_SMALL_FAST_MODEL"] = model_name
+    return env
+
+def run_claude(model_name, session_id=None, system_prompt=None):
+    """Runs the main claude CLI; the proxy is left running for the next session"""
+    env = claude_env(model_name)
     
     cmd = ["claude"]
     
@@ -159,10 +455,6 @@ def run_claude(proxy_pid=None, session_id=None, system_prompt=None):
         subprocess.run(cmd, env=env)
     except KeyboardInterrupt:
         pass
-    finally:
-        if proxy_pid:
-            print(f"\n{Colors.BLUE}Stopping proxy...{Colors.ENDC}")
-            proxy_pid.kill()
 
 def menu_provider_selection(config):
     providers = [
@@ -277,7 +569,14 @@ def doctor():
         status = f"{Colors.GREEN}OK{Colors.ENDC}" if found else f"{Colors.FAIL}Missing{Colors.ENDC}"
         print(f"   {cmd}: {status}")
         
-    print("\n3. Checking Termux Specifics...")
+    print("\n3. Checking LiteLLM Proxy...")
+    state = read_litellm_state()
+    if state:
+        print(f"   Running: pid {state['pid']} on port {state['port']}, models: {', '.join(state['models'])}")
+    else:
+        print("   Not running (started on demand)")
+
+    print("\n4. Checking Termux Specifics...")
     if "ANDROID_ROOT" in os.environ:
         print("   Running in Termux environment.")
         try:
@@ -336,9 +635,8 @@ def main():
             if provider:
                 model, env = configure_provider(provider, config)
                 if model: # If None, it means it was handled internally (MiniMax)
-                    proc = start_litellm(model, env)
-                    if proc:
-                        run_claude(proc, system_prompt=config.get("system_prompt"))
+                    if start_litellm(model, env, config):
+                        run_claude(model, system_prompt=config.get("system_prompt"))
                 input("\nPress Enter to return to menu...")
                 
         elif choice == "2":
@@ -352,19 +650,15 @@ def main():
             if provider:
                 model, env = configure_provider(provider, config)
                 if model:
-                    proc = start_litellm(model, env)
-                    if proc:
+                    if start_litellm(model, env, config):
                         # Pass --resume flag only
-                        env = os.environ.copy()
-                        env["ANTHROPIC_BASE_URL"] = LITELLM_HOST
-                        env["ANTHROPIC_API_KEY"] = "sk-litellm-proxy"
-                        env["ANTHROPIC_MODEL"] = "claude-3-sonnet-20240229"
+                        env = claude_env(model)
+                        print("Launching Claude in Resume mode...")
+                        # claude --resume interactive picker
                         try:
-                            print("Launching Claude in Resume mode...")
-                            # claude --resume interactive picker
-                            subprocess.run(["claude", "--resume"], env=env) 
-                        finally:
-                            proc.kill()
+                            subprocess.run(["claude", "--resume"], env=env)
+                        except KeyboardInterrupt:
+                            pass
                             
         elif choice == "3":
             sid = list_sessions()
@@ -375,14 +669,14 @@ def main():
                 if provider:
                     model, env = configure_provider(provider, config)
                     if model:
-                        proc = start_litellm(model, env)
-                        if proc:
-                            run_claude(proc, session_id=sid)
+                        if start_litellm(model, env, config):
+                            run_claude(model, session_id=sid)
         
         elif choice == "4":
             print(f"\n{Colors.HEADER}Settings{Colors.ENDC}")
             print("1. Set System Prompt (Persona)")
             print("2. Clear API Keys")
+            print("3. Stop LiteLLM Proxy")
             sc = input("Choice: ")
             if sc == "1":
                 p = input("Enter new System Prompt (Enter to clear): ")
@@ -393,6 +687,9 @@ def main():
                 save_config(config)
                 print("Keys cleared.")
                 time.sleep(1)
+            elif sc == "3":
+                print("Proxy stopped." if stop_litellm() else "No proxy running.")
+                time.sleep(1)
                 
         elif choice == "5":
             doctor()
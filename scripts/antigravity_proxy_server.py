@@ -4,27 +4,170 @@ AntiGravity Proxy Server
 Simple proxy to handle Google internal authentication
 """
 
+import argparse
+import bisect
+import email.utils
+import hashlib
 import json
 import os
+import queue
+import random
+import select
+import ssl
 import sys
+import tempfile
+import http.client
 import http.server
 import socketserver
+import sqlite3
+import threading
+import time
 import urllib.parse
 import urllib.request
+import uuid
+from collections import OrderedDict, deque
 from datetime import datetime
 
-class AntiGravityProxyHandler(http.server.BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.end_headers()
+AUTH_DIR = os.path.expanduser("~/.config/claude-all/antigravity")
+CACHE_DIR = os.path.expanduser("~/.cache/claude-all/antigravity-proxy")
+MB = 1024 * 1024
+GOOGLE_TOKEN_URI = "https://oauth2.googleapis.com/token"
 
-        if self.path == '/health':
-            response = {"status": "ok", "service": "antigravity-proxy"}
-            self.wfile.write(json.dumps(response).encode())
-        elif self.path == '/':
-            # Simple UI
-            html = """
+DEFAULT_PORT = 8080
+DEFAULT_MAX_CONCURRENCY = 32
+# Idle upstream connections kept per host; enough to reuse one for every concurrent request
+DEFAULT_POOL_SIZE = DEFAULT_MAX_CONCURRENCY
+DEFAULT_BACKLOG = 128
+# Seconds a kept-alive client connection may sit idle between requests
+KEEPALIVE_TIMEOUT = 15
+DEFAULT_MAX_BODY_MB = 32
+STREAM_CHUNK_SIZE = 16 * 1024
+UPSTREAM_TIMEOUT = 600
+DEFAULT_POOL_IDLE_TIMEOUT = 90
+DEFAULT_REFRESH_MARGIN = 300
+TOKEN_EXPIRY_SKEW = 30
+TOKEN_CHECK_INTERVAL = 15
+DEFAULT_SCHEDULE = 'least-in-flight'
+DEFAULT_COOLDOWN = 60
+# Provider routing: seconds out after a 5xx or failed connection, EWMA weight, error-rate penalty
+DEFAULT_PROVIDER_COOLDOWN = 10
+PROVIDER_EWMA_ALPHA = 0.3
+PROVIDER_ERROR_PENALTY = 4
+# Providers unused for this long are tried again in case they have recovered
+PROVIDER_REPROBE_INTERVAL = 60
+DEFAULT_QUEUE_TIMEOUT = 60
+# Retries after every provider failed: full-jitter exponential backoff, capped
+DEFAULT_RETRIES = 2
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
+DEFAULT_MAX_RETRY_WAIT = 30
+# Hedging waits for a provider's p95 time to response over this many recent successes
+HEDGE_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+# Creating a message has no side effects, so these can be retried after any failure
+IDEMPOTENT_PATHS = ('/v1/messages', '/v1/messages/count_tokens')
+# Statuses that mean the upstream refused the request without acting on it
+UNPROCESSED_STATUSES = (429, 503, 529)
+DEFAULT_CACHE_TTL = 24 * 3600
+DEFAULT_CACHE_ENTRIES = 1024
+DEFAULT_CACHE_MEMORY_MB = 64
+DEFAULT_CACHE_DISK_MB = 512
+
+# Request fields that never change the model output
+CACHE_IGNORED_FIELDS = ('metadata',)
+# Request headers that distinguish otherwise identical requests
+KEY_HEADERS = ('Anthropic-Beta', 'Authorization', 'X-Api-Key')
+
+METRICS_PREFIX = 'antigravity_proxy'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+METRICS_HELP = {
+    'requests_total': ('counter', 'Requests to /v1/* by model and response status'),
+    'upstream_errors_total': ('counter', 'Upstream failures by model and status (connect = no response)'),
+    'bytes_in_total': ('counter', 'Request body bytes received by model'),
+    'bytes_out_total': ('counter', 'Response body bytes sent by model'),
+    'cache_requests_total': ('counter', 'Response cache lookups by result'),
+    'coalesced_requests_total': ('counter', 'Requests served by joining an identical in-flight request'),
+    'provider_requests_total': ('counter', 'Upstream attempts by provider and status (connect = no response)'),
+    'failovers_total': ('counter', 'Requests moved to the next provider, by the provider that failed'),
+    'retries_total': ('counter', 'Requests retried after backoff once every provider failed, by last status'),
+    'hedged_requests_total': ('counter', 'Second attempts started because the first was slower than p95'),
+    'hedge_wins_total': ('counter', 'Hedged requests answered first by the second attempt'),
+    'prompt_cache_breakpoints_total': ('counter', 'cache_control breakpoints added to requests, by provider'),
+    'prompt_cache_requests_total': ('counter', 'Responses by provider and prompt cache result (hit, write or miss)'),
+    'prompt_cache_tokens_total': ('counter', 'Input tokens by provider and type (read from cache, written, uncached)'),
+    'queue_timeouts_total': ('counter', 'Requests rejected after waiting too long for a provider rate limit'),
+    'queue_wait_seconds': ('histogram', 'Time requests waited for a provider rate limit or concurrency slot'),
+    'request_duration_seconds': ('histogram', 'Time from request received to last byte sent'),
+    'time_to_first_byte_seconds': ('histogram', 'Time from request received to first body byte sent'),
+}
+
+# Request headers passed through to an Anthropic-compatible upstream
+FORWARDED_HEADERS = ('Content-Type', 'Authorization', 'X-Api-Key', 'Anthropic-Version', 'Anthropic-Beta')
+
+# APIs the proxy can translate Anthropic Messages requests into
+UPSTREAM_FORMATS = ('anthropic', 'openai', 'gemini')
+OPENAI_STOP_REASONS = {'stop': 'end_turn', 'length': 'max_tokens', 'tool_calls': 'tool_use',
+                       'function_call': 'tool_use', 'content_filter': 'end_turn'}
+OPENAI_TOOL_CHOICES = {'auto': 'auto', 'any': 'required', 'none': 'none'}
+GEMINI_STOP_REASONS = {'STOP': 'end_turn', 'MAX_TOKENS': 'max_tokens'}
+GEMINI_TOOL_MODES = {'auto': 'AUTO', 'any': 'ANY', 'tool': 'ANY', 'none': 'NONE'}
+GEMINI_UNSUPPORTED_SCHEMA_KEYS = ('$schema', '$id', 'additionalProperties', 'default', 'examples',
+                                  'const', 'exclusiveMinimum', 'exclusiveMaximum', 'propertyNames')
+# Prompt caching: Anthropic allows four cache_control breakpoints per request,
+# and prefixes shorter than about 1024 tokens are not cached
+CACHE_CONTROL = {'type': 'ephemeral'}
+# cache_control ttl values, in seconds; a breakpoint may not come before one with a longer ttl
+CACHE_TTLS = {'5m': 300, '1h': 3600}
+MAX_CACHE_BREAKPOINTS = 4
+PROMPT_CACHE_MIN_TOKENS = 1024
+# Text that starts the superpowers session-start hook's skill bootstrap
+SKILL_BOOTSTRAP_MARKER = 'You have superpowers.'
+# Gemini context caches: minimum prefix worth caching, lifetime and reuse margin
+GEMINI_CACHE_MIN_TOKENS = 4096
+GEMINI_CACHE_TTL = 300
+GEMINI_CACHE_MARGIN = 30
+GEMINI_CACHED_FIELDS = ('systemInstruction', 'tools', 'toolConfig')
+USAGE_KEY = b'"usage":'
+ERROR_TYPES = {400: 'invalid_request_error', 401: 'authentication_error', 403: 'permission_error',
+               404: 'not_found_error', 413: 'request_too_large', 429: 'rate_limit_error',
+               529: 'overloaded_error'}
+
+
+class BoundedThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Thread-per-connection server with a cap on concurrently handled API requests.
+
+    A /v1/* request holds one of the max_concurrency slots while it is being
+    handled, so idle keep-alive clients never block others and /health and
+    /metrics never queue behind upstream calls; requests beyond the cap wait
+    for a slot.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    keep_alive = True
+
+    def __init__(self, server_address, handler_class, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 backlog=DEFAULT_BACKLOG):
+        self.request_queue_size = backlog
+        self.request_slots = threading.BoundedSemaphore(max_concurrency)
+        super().__init__(server_address, handler_class)
+
+
+class SimpleHTTPServer(socketserver.TCPServer):
+    """Original single-threaded server, one request at a time.
+
+    Connections are closed after each response so one client cannot hold
+    the only handler by keeping its connection alive.
+    """
+    allow_reuse_address = True
+    keep_alive = False
+    request_slots = None
+
+    def __init__(self, server_address, handler_class, backlog=DEFAULT_BACKLOG):
+        self.request_queue_size = backlog
+        super().__init__(server_address, handler_class)
+
+
+INDEX_HTML = """
             <!DOCTYPE html>
             <html>
             <head>
@@ -54,7 +197,1863 @@ class AntiGravityProxyHandler(http.server.BaseHTTPRequestHandler):
             </body>
             </html>
             """
-            self.wfile.write(html.encode())
+
+
+def sse_event(event, data):
+    """Encode one Anthropic-style server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+def mock_response_text(model, messages):
+    # For now, return a mock response
+    # In production, this would call the actual AntiGravity API
+    return (f"[AntiGravity Proxy] Received request for model: {model}\n\nThis is a proxy response. The actual implementation would:\n1. Authenticate with Google internal systems\n2. Route to AntiGravity API\n3. Return the real model response\n\nYour message: {messages[-1]['content'] if messages else 'No message'}")
+
+
+def iter_mock_sse(message_id, model, text):
+    """Yield the mock response as the Anthropic streaming event sequence."""
+    yield sse_event('message_start', {
+        "type": "message_start",
+        "message": {
+            "id": message_id,
+            "type": "message",
+            "role": "assistant",
+            "content": [],
+            "model": model,
+            "stop_reason": None,
+            "stop_sequence": None,
+            "usage": {"input_tokens": 10, "output_tokens": 1}
+        }
+    })
+    yield sse_event('content_block_start', {
+        "type": "content_block_start",
+        "index": 0,
+        "content_block": {"type": "text", "text": ""}
+    })
+    yield sse_event('ping', {"type": "ping"})
+    for piece in text.splitlines(keepends=True):
+        yield sse_event('content_block_delta', {
+            "type": "content_block_delta",
+            "index": 0,
+            "delta": {"type": "text_delta", "text": piece}
+        })
+    yield sse_event('content_block_stop', {"type": "content_block_stop", "index": 0})
+    yield sse_event('message_delta', {
+        "type": "message_delta",
+        "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+        "usage": {"output_tokens": 50}
+    })
+    yield sse_event('message_stop', {"type": "message_stop"})
+
+
+def read_body(rfile, length):
+    """Read exactly length bytes into one preallocated buffer.
+
+    json.loads parses the buffer directly and it is forwarded upstream
+    as is, so a large conversation is held in memory only once.
+    """
+    body = bytearray(length)
+    view = memoryview(body)
+    received = 0
+    while received < length:
+        n = rfile.readinto(view[received:])
+        if not n:
+            raise ConnectionError(f"Client closed the connection after {received} of {length} body bytes")
+        received += n
+    view.release()
+    return body
+
+
+def iter_response_chunks(response, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield an upstream response body as it arrives, without buffering it all."""
+    read = getattr(response, 'read1', response.read)
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+class PooledResponse:
+    """Upstream response that hands its connection back to the pool when closed.
+
+    The connection is only reused if the body was read to the end and the
+    upstream did not ask to close it; anything else is discarded.
+    """
+
+    def __init__(self, pool, key, conn, response):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.status = response.status
+        self.headers = response.headers
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+    def read1(self, amt=-1):
+        return self._response.read1(amt)
+
+    def close(self):
+        if self._conn is None:
+            return
+        response = self._response
+        drained = response.isclosed() or response.length == 0
+        reusable = drained and not response.will_close
+        response.close()
+        self._pool.release(self._key, self._conn, reusable)
+        self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class UpstreamPool:
+    """Keep-alive HTTP/1.1 connections per upstream host, shared by all handler threads.
+
+    A request never waits for a connection: one is opened whenever no idle
+    one is available, and at most max_idle_per_host are kept for reuse
+    afterwards. Idle connections older than idle_timeout, or whose socket
+    became readable (the upstream closed it), are evicted instead of reused.
+    """
+
+    def __init__(self, max_idle_per_host=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT,
+                 timeout=UPSTREAM_TIMEOUT):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def request(self, method, url, body=None, headers=None):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        # A pooled connection may have been closed by the upstream between
+        # the health check and our write; retry once on a fresh connection.
+        for attempt in range(2):
+            conn, fresh = self._checkout(key)
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                conn.close()
+                if fresh or attempt:
+                    raise
+                continue
+            except Exception:
+                conn.close()
+                raise
+            return PooledResponse(self, key, conn, response)
+
+    def release(self, key, conn, reusable):
+        if reusable:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.max_idle_per_host:
+                    idle.append((conn, time.monotonic()))
+                    return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+
+    def _checkout(self, key):
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used < self.idle_timeout and self._is_healthy(conn):
+                    return conn, False
+                conn.close()
+
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=self.timeout,
+                                               context=ssl.create_default_context())
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        return conn, True
+
+    @staticmethod
+    def _is_healthy(conn):
+        # An idle keep-alive socket should have nothing to read; readable means EOF or garbage
+        if conn.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+
+def parse_expiry(credentials, written_at):
+    """Return the absolute expiry (epoch seconds) of the stored access token.
+
+    expiry_date is epoch milliseconds as written by Google tooling. Files from
+    older setup scripts stored the relative expires_in there instead, which is
+    resolved against the time the file was written.
+    """
+    expiry = credentials.get('expiry_date')
+    if isinstance(expiry, (int, float)) and expiry > 0:
+        if expiry > 1e12:
+            return expiry / 1000.0
+        if expiry > 1e9:
+            return float(expiry)
+        return written_at + expiry
+    if isinstance(credentials.get('expiry'), str):
+        try:
+            return datetime.fromisoformat(credentials['expiry'].replace('Z', '+00:00')).timestamp()
+        except ValueError:
+            pass
+    return 0.0
+
+
+class TokenCache:
+    """Access token for one OAuth credentials file, kept in memory.
+
+    TokenRefresher renews it ahead of expiry in the background; refresh() is
+    single-flight, so concurrent callers share one token request. The renewed
+    token is written back to the file atomically.
+    """
+
+    def __init__(self, path, refresh_margin=DEFAULT_REFRESH_MARGIN):
+        self.path = path
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._inflight = None
+        with open(path) as f:
+            self._credentials = json.load(f)
+        self.access_token = self._credentials.get('access_token') or ''
+        self.expires_at = parse_expiry(self._credentials, os.path.getmtime(path))
+
+    @property
+    def label(self):
+        return self._credentials.get('label') or os.path.basename(self.path)
+
+    @property
+    def can_refresh(self):
+        return bool(self._credentials.get('refresh_token') and self._credentials.get('client_id'))
+
+    def needs_refresh(self, now=None):
+        now = time.time() if now is None else now
+        return self.can_refresh and now >= self.expires_at - self.refresh_margin
+
+    def get_token(self):
+        """Return a valid access token, refreshing synchronously only if it already expired."""
+        if self.access_token and time.time() < self.expires_at - TOKEN_EXPIRY_SKEW:
+            return self.access_token
+        if self.can_refresh:
+            self.refresh()
+        return self.access_token
+
+    def refresh(self):
+        with self._lock:
+            if self._inflight is not None:
+                done, leader = self._inflight, False
+            else:
+                done, leader = threading.Event(), True
+                self._inflight = done
+
+        if not leader:
+            done.wait(UPSTREAM_TIMEOUT)
+            return
+
+        try:
+            self._refresh()
+        finally:
+            with self._lock:
+                self._inflight = None
+            done.set()
+
+    def _refresh(self):
+        creds = self._credentials
+        form = urllib.parse.urlencode({
+            'client_id': creds['client_id'],
+            'client_secret': creds.get('client_secret', ''),
+            'refresh_token': creds['refresh_token'],
+            'grant_type': 'refresh_token'
+        }).encode()
+        req = urllib.request.Request(
+            creds.get('token_uri', GOOGLE_TOKEN_URI),
+            data=form,
+            headers={'Content-Type': 'application/x-www-form-urlencoded'}
+        )
+        requested_at = time.time()
+        with urllib.request.urlopen(req, timeout=30) as response:
+            token_info = json.loads(response.read())
+
+        updated = dict(creds)
+        updated['access_token'] = token_info['access_token']
+        updated['expiry_date'] = int((requested_at + token_info.get('expires_in', 3600)) * 1000)
+        if token_info.get('refresh_token'):
+            updated['refresh_token'] = token_info['refresh_token']
+        self._write_back(updated)
+
+        with self._lock:
+            self._credentials = updated
+            self.access_token = updated['access_token']
+            self.expires_at = updated['expiry_date'] / 1000.0
+
+    def _write_back(self, credentials):
+        # Write to a temp file in the same directory, then rename over the original
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.auth-', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(credentials, f, indent=2)
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+
+class TokenRefresher(threading.Thread):
+    """Background thread that refreshes tokens before they expire."""
+
+    def __init__(self, caches, interval=TOKEN_CHECK_INTERVAL):
+        super().__init__(name='token-refresher', daemon=True)
+        self.caches = caches
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            for cache in self.caches:
+                if cache.needs_refresh():
+                    try:
+                        cache.refresh()
+                    except Exception as e:
+                        print(f"⚠️  Token refresh failed for {cache.label}: {e}", file=sys.stderr)
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date)."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class Account:
+    """One set of credentials in the pool plus its scheduling state."""
+
+    def __init__(self, token_cache):
+        self.token_cache = token_cache
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.rate_limited = 0
+
+    @property
+    def label(self):
+        return self.token_cache.label
+
+
+class CredentialPool:
+    """Spread upstream requests across every configured account.
+
+    round-robin rotates through accounts; least-in-flight picks the account
+    with the fewest requests currently running. An account that gets a 429
+    sits out until its Retry-After (or the default cooldown) has passed.
+    """
+
+    def __init__(self, caches, strategy=DEFAULT_SCHEDULE, cooldown=DEFAULT_COOLDOWN):
+        if not caches:
+            raise ValueError("Credential pool needs at least one account")
+        self.accounts = [Account(cache) for cache in caches]
+        self.strategy = strategy
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._next = 0
+
+    @property
+    def caches(self):
+        return [account.token_cache for account in self.accounts]
+
+    def acquire(self):
+        now = time.monotonic()
+        with self._lock:
+            count = len(self.accounts)
+            # Rotation order starting after the last pick keeps ties fair
+            ordered = [self.accounts[(self._next + i) % count] for i in range(count)]
+            ready = [account for account in ordered if account.cooldown_until <= now]
+            if not ready:
+                # Everyone is cooling down; use whoever comes back first
+                account = min(ordered, key=lambda a: a.cooldown_until)
+            elif self.strategy == 'least-in-flight':
+                account = min(ready, key=lambda a: a.in_flight)
+            else:
+                account = ready[0]
+            self._next = (self.accounts.index(account) + 1) % count
+            account.in_flight += 1
+            account.requests += 1
+            return account
+
+    def has_ready(self):
+        """Whether any account is out of its cooldown."""
+        now = time.monotonic()
+        with self._lock:
+            return any(account.cooldown_until <= now for account in self.accounts)
+
+    def rate_limited(self, account, retry_after=None):
+        """Bench the account after a 429 until Retry-After, or the default cooldown, has passed."""
+        delay = parse_retry_after(retry_after)
+        with self._lock:
+            account.rate_limited += 1
+            account.cooldown_until = time.monotonic() + (self.cooldown if delay is None else delay)
+
+    def release(self, account, status=None, retry_after=None):
+        if status == 429:
+            self.rate_limited(account, retry_after)
+        with self._lock:
+            account.in_flight -= 1
+
+
+class RateLimiter:
+    """Admission control for one provider: RPM and estimated TPM buckets plus AIMD concurrency.
+
+    A request waits until both token buckets can pay for it and fewer than
+    `limit` requests are running. A 429 halves the limit and, with
+    Retry-After, holds new requests back until then; every success grows
+    the limit by 1/limit, about one slot per limit successes.
+    """
+
+    def __init__(self, rpm=None, tpm=None, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        # Bucket state: [capacity, refill per second, available]
+        self._buckets = [[per_minute, per_minute / 60.0, float(per_minute)] for per_minute in (rpm, tpm)
+                         if per_minute]
+        self._bucket_costs = [cost for cost, per_minute in (('requests', rpm), ('tokens', tpm)) if per_minute]
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        for bucket in self._buckets:
+            bucket[2] = min(bucket[0], bucket[2] + elapsed * bucket[1])
+
+    def _wait_time(self, costs, now):
+        """Seconds until the request could be admitted; 0 means now."""
+        wait = max(0.0, self.blocked_until - now)
+        for bucket, cost in zip(self._buckets, costs):
+            if bucket[2] < cost:
+                wait = max(wait, (cost - bucket[2]) / bucket[1])
+        if self.in_flight >= max(1, int(self.limit)):
+            # Woken by release(); poll anyway in case the limit grew
+            wait = max(wait, 1.0)
+        return wait
+
+    def acquire(self, tokens, timeout):
+        """Wait up to timeout seconds for a slot; returns the seconds waited, or None on timeout."""
+        started = time.monotonic()
+        deadline = started + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                costs = [1 if kind == 'requests' else min(tokens, bucket[0])
+                         for kind, bucket in zip(self._bucket_costs, self._buckets)]
+                wait = self._wait_time(costs, now)
+                if wait == 0:
+                    for bucket, cost in zip(self._buckets, costs):
+                        bucket[2] -= cost
+                    self.in_flight += 1
+                    return now - started
+                if now >= deadline:
+                    return None
+                self._cond.wait(min(wait, deadline - now))
+
+    def feedback(self, status, retry_after=None):
+        """Adjust the concurrency limit from the upstream's answer."""
+        with self._cond:
+            if status == 429:
+                self.limit = max(1.0, self.limit / 2)
+                delay = parse_retry_after(retry_after)
+                if delay:
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            elif status is not None and status < 400:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+
+def estimate_tokens(body):
+    """Rough prompt size for TPM budgeting: about 4 bytes of request JSON per token."""
+    return max(1, len(body or b'') // 4)
+
+
+class Provider:
+    """One upstream API the router can send requests to, with its rolling health.
+
+    models maps the model names clients ask for to the provider's own names;
+    '*' serves any model under the name the client used.
+    """
+
+    def __init__(self, name, base_url, upstream_format='anthropic', api_key=None, models=None,
+                 use_accounts=False, limiter=None, prompt_cache=True):
+        if upstream_format not in UPSTREAM_FORMATS:
+            raise ValueError(f"Provider {name}: unknown format {upstream_format!r}")
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.format = upstream_format
+        self.api_key = api_key
+        self.models = models or {'*': None}
+        self.use_accounts = use_accounts
+        self.prompt_cache = prompt_cache
+        self.limiter = limiter or RateLimiter()
+        self.latency = None
+        # Recent successful response times, for the hedging delay
+        self.response_times = deque(maxlen=HEDGE_WINDOW)
+        self.error_rate = 0.0
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.last_used = 0.0
+
+    def model_for(self, model):
+        """The provider's name for model, or None if it does not serve it."""
+        if model in self.models:
+            return self.models[model] or model
+        if '*' in self.models:
+            return model
+        return None
+
+
+class ProviderRouter:
+    """Send each request to the fastest healthy provider serving its model.
+
+    Providers are ranked by an EWMA of time to response headers, inflated by
+    their recent error rate. Providers cooling down after a 429 or 5xx rank
+    last; untried providers, and ones idle for PROVIDER_REPROBE_INTERVAL,
+    rank first so every provider keeps getting measured.
+    """
+
+    def __init__(self, providers, cooldown=DEFAULT_PROVIDER_COOLDOWN):
+        self.providers = providers
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+
+    def candidates(self, model):
+        """(provider, provider model) pairs serving model, best first."""
+        now = time.monotonic()
+        with self._lock:
+            serving = [(p, p.model_for(model)) for p in self.providers]
+            serving = [(p, name) for p, name in serving if name is not None]
+            return sorted(serving, key=lambda item: self._rank(item[0], now))
+
+    @staticmethod
+    def _rank(provider, now):
+        if provider.cooldown_until > now:
+            return (1, provider.cooldown_until)
+        if now - provider.last_used > PROVIDER_REPROBE_INTERVAL:
+            return (0, 0.0)
+        latency = provider.latency or 0.0
+        return (0, latency * (1 + PROVIDER_ERROR_PENALTY * provider.error_rate))
+
+    @staticmethod
+    def is_failure(status):
+        # None means no response at all; client errors are not the provider's fault
+        return status is None or status == 429 or status >= 500
+
+    def record(self, provider, status, latency, retry_after=None):
+        """Update the provider's health; latency is None for requests that say nothing about speed."""
+        failed = self.is_failure(status)
+        with self._lock:
+            provider.requests += 1
+            provider.last_used = time.monotonic()
+            provider.error_rate += PROVIDER_EWMA_ALPHA * (float(failed) - provider.error_rate)
+            if failed:
+                provider.failures += 1
+                delay = parse_retry_after(retry_after) if status == 429 else None
+                provider.cooldown_until = time.monotonic() + (self.cooldown if delay is None else delay)
+                return
+            if latency is None:
+                return
+            provider.response_times.append(latency)
+            if provider.latency is None:
+                provider.latency = latency
+            else:
+                provider.latency += PROVIDER_EWMA_ALPHA * (latency - provider.latency)
+
+    def hedge_delay(self, provider):
+        """The provider's p95 time to response, or None until enough requests have succeeded."""
+        with self._lock:
+            samples = sorted(provider.response_times)
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[int(0.95 * (len(samples) - 1))]
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            return [{
+                'name': p.name,
+                'format': p.format,
+                'latency_ms': round(p.latency * 1000) if p.latency is not None else None,
+                'error_rate': round(p.error_rate, 3),
+                'cooling_down_s': round(max(0.0, p.cooldown_until - now), 1),
+                'requests': p.requests,
+                'failures': p.failures,
+                'in_flight': p.limiter.in_flight,
+                'concurrency_limit': round(p.limiter.limit, 2),
+            } for p in self.providers]
+
+
+def is_retryable(status, idempotent):
+    """Whether a failed attempt may be sent again, to this provider or another."""
+    if idempotent:
+        return ProviderRouter.is_failure(status)
+    # The upstream may have acted on anything else, e.g. created a batch
+    return status in UNPROCESSED_STATUSES
+
+
+def retry_delay(attempt, retry_after, max_wait):
+    """Full-jitter exponential backoff, never sooner than Retry-After; None if that is over max_wait."""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    wait = parse_retry_after(retry_after)
+    if wait is not None:
+        if wait > max_wait:
+            return None
+        delay = max(delay, wait)
+    return delay
+
+
+class HedgedRequest:
+    """Upstream attempts racing in background threads; the caller takes results as they finish.
+
+    Results that arrive after finish() are closed, which releases their
+    connection, account and rate limiter slot.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.started = 0
+        self.pending = 0
+        self._results = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._finished = False
+
+    def start(self, attempt, *args):
+        """Run attempt(*args, metrics=...) in the background; returns its index in start order."""
+        index = self.started
+        self.started += 1
+        self.pending += 1
+        threading.Thread(target=self._run, args=(index, attempt) + args, daemon=True).start()
+        return index
+
+    def _run(self, index, attempt, *args):
+        # Handler metrics shards are not thread-safe, so each attempt borrows its own
+        shard = self.metrics.borrow()
+        try:
+            result = attempt(*args, metrics=shard)
+        except Exception as e:
+            result = (api_error_response(502, f"Upstream request failed: {e}"), None, None)
+        finally:
+            self.metrics.give_back(shard)
+        with self._lock:
+            if not self._finished:
+                self._results.put(result + (index,))
+                return
+        result[0].close()
+
+    def wait(self, timeout=None):
+        """(response, status, retry_after, index) of the next attempt to finish, or None on timeout."""
+        try:
+            result = self._results.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        self.pending -= 1
+        return result
+
+    def finish(self):
+        """Stop taking results and close the ones nobody will read."""
+        with self._lock:
+            self._finished = True
+        while True:
+            try:
+                self._results.get_nowait()[0].close()
+            except queue.Empty:
+                return
+
+
+def load_providers(args):
+    """Providers from --providers-file, then --upstream as a catch-all for any model."""
+    providers = []
+    if args.providers_file:
+        with open(args.providers_file) as f:
+            config = json.load(f)
+        entries = config.get('providers', []) if isinstance(config, dict) else config
+        for entry in entries:
+            api_key = entry.get('api_key') or os.environ.get(entry.get('api_key_env', '')) or None
+            limiter = RateLimiter(entry.get('rpm'), entry.get('tpm'),
+                                  entry.get('max_concurrency', args.provider_concurrency))
+            providers.append(Provider(entry['name'], entry['base_url'], entry.get('format', 'anthropic'),
+                                      api_key=api_key, models=entry.get('models'),
+                                      use_accounts=entry.get('accounts', False), limiter=limiter,
+                                      prompt_cache=entry.get('prompt_cache', True)))
+    if args.upstream:
+        limiter = RateLimiter(args.rpm, args.tpm, args.provider_concurrency)
+        providers.append(Provider('upstream', args.upstream, args.upstream_format, use_accounts=True,
+                                  limiter=limiter))
+    return providers
+
+
+def load_credential_pool(args):
+    """Build the credential pool from --auth-file, or every *.json in --auth-dir."""
+    if args.auth_file:
+        paths = args.auth_file
+    elif args.upstream_format == 'openai':
+        # Google accounts mean nothing to OpenAI-style APIs; clients send their own key
+        paths = []
+    elif os.path.isdir(args.auth_dir):
+        paths = sorted(os.path.join(args.auth_dir, f) for f in os.listdir(args.auth_dir) if f.endswith('.json'))
+    else:
+        paths = []
+
+    caches = []
+    for path in paths:
+        try:
+            cache = TokenCache(path, refresh_margin=args.refresh_margin)
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"⚠️  Skipping {path}: {e}", file=sys.stderr)
+            continue
+        if not cache.access_token and not cache.can_refresh:
+            print(f"⚠️  Skipping {path}: no access_token or refresh_token", file=sys.stderr)
+            continue
+        caches.append(cache)
+
+    if not caches:
+        return None
+    return CredentialPool(caches, strategy=args.schedule, cooldown=args.cooldown)
+
+
+def is_deterministic(request_data):
+    """Only temperature 0 requests give repeatable answers worth caching."""
+    return request_data.get('temperature') == 0
+
+
+def request_cache_key(variant, request_data):
+    """Hash of the request with keys sorted, ignoring fields that don't affect the output."""
+    canonical = {k: v for k, v in request_data.items() if k not in CACHE_IGNORED_FIELDS}
+    encoded = json.dumps(canonical, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(f"{variant}\n{encoded}".encode()).hexdigest()
+
+
+def stream_completed(body):
+    """True if an SSE body reached message_stop and carried no error event."""
+    events = {line[len(b'event:'):].strip() for line in body.splitlines() if line.startswith(b'event:')}
+    return b'message_stop' in events and b'error' not in events
+
+
+class ResponseCache:
+    """Content-addressed cache of complete 200 responses.
+
+    Entries live in an in-memory LRU bounded by count and bytes, backed by an
+    optional sqlite file bounded by bytes. Entries older than ttl seconds are
+    treated as misses and dropped from both tiers.
+    """
+
+    def __init__(self, ttl=DEFAULT_CACHE_TTL, max_entries=DEFAULT_CACHE_ENTRIES,
+                 memory_bytes=DEFAULT_CACHE_MEMORY_MB * MB, disk_bytes=DEFAULT_CACHE_DISK_MB * MB, path=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.max_entry_bytes = max(1, memory_bytes // 4)
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._db = None
+        self._disk_used = 0
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, content_type TEXT, body BLOB, size INTEGER, "
+                "created REAL, accessed REAL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self._db.execute("DELETE FROM responses WHERE created < ?", (time.time() - ttl,))
+            self._disk_used = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key):
+        """Return (content_type, body) for a fresh entry, or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, content_type, body = entry
+                if now - created < self.ttl:
+                    self._memory.move_to_end(key)
+                    return content_type, body
+                self._drop_memory(key)
+
+            if self._db is None:
+                return None
+            row = self._db.execute(
+                "SELECT content_type, body, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            content_type, body, created = row
+            if now - created >= self.ttl:
+                self._drop_disk(key)
+                return None
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            # Promote to the memory tier for the next hit
+            self._store_memory(key, created, content_type, bytes(body))
+            return content_type, bytes(body)
+
+    def put(self, key, content_type, body):
+        if len(body) > self.max_entry_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            self._store_memory(key, now, content_type, body)
+            if self._db is not None:
+                self._drop_disk(key)
+                self._db.execute(
+                    "INSERT INTO responses (key, content_type, body, size, created, accessed) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, content_type, body, len(body), now, now)
+                )
+                self._disk_used += len(body)
+                self._evict_disk()
+
+    def collect(self, key, content_type, chunks):
+        """Pass chunks through unchanged and cache the full body once it completes.
+
+        Event streams are only cached if they reached message_stop without an
+        error event, so a mid-stream overloaded_error is never replayed.
+        """
+        parts, size = [], 0
+        try:
+            for chunk in chunks:
+                if parts is not None:
+                    size += len(chunk)
+                    if size > self.max_entry_bytes:
+                        parts = None
+                    else:
+                        parts.append(chunk)
+                yield chunk
+        finally:
+            close_chunks = getattr(chunks, 'close', None)
+            if close_chunks is not None:
+                close_chunks()
+        if parts is not None:
+            body = b''.join(parts)
+            if not content_type.startswith('text/event-stream') or stream_completed(body):
+                self.put(key, content_type, body)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+
+    def _store_memory(self, key, created, content_type, body):
+        self._drop_memory(key)
+        self._memory[key] = (created, content_type, body)
+        self._memory_used += len(body)
+        while self._memory and (len(self._memory) > self.max_entries or self._memory_used > self.memory_bytes):
+            _, (_, _, evicted) = self._memory.popitem(last=False)
+            self._memory_used -= len(evicted)
+
+    def _drop_memory(self, key):
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self._memory_used -= len(entry[2])
+
+    def _drop_disk(self, key):
+        row = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._disk_used -= row[0]
+
+    def _evict_disk(self):
+        cutoff = time.time() - self.ttl
+        expired = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses WHERE created < ?", (cutoff,)
+        ).fetchone()[0]
+        if expired:
+            self._db.execute("DELETE FROM responses WHERE created < ?", (cutoff,))
+            self._disk_used -= expired
+        # Least recently used first until we are back under budget
+        while self._disk_used > self.disk_bytes:
+            row = self._db.execute(
+                "SELECT key, size FROM responses ORDER BY accessed LIMIT 1"
+            ).fetchone()
+            if row is None:
+                self._disk_used = 0
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (row[0],))
+            self._disk_used -= row[1]
+
+
+class Flight:
+    """One upstream response shared by identical requests that overlap in time.
+
+    The leader appends chunks as they arrive; followers replay everything
+    received so far and then block for more, so streams fan out live. A
+    follower gives up once nothing has happened for timeout seconds.
+    """
+
+    def __init__(self, timeout=UPSTREAM_TIMEOUT):
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._chunks = []
+        self._started = False
+        self._done = False
+        self.followers = 0
+        self.status = None
+        self.content_type = None
+        self.streamed = False
+
+    def start(self, status, content_type, streamed):
+        with self._cond:
+            self.status, self.content_type, self.streamed = status, content_type, streamed
+            self._started = True
+            self._cond.notify_all()
+
+    def append(self, chunk):
+        with self._cond:
+            self._chunks.append(chunk)
+            self._cond.notify_all()
+
+    def finish(self):
+        with self._cond:
+            self._done = True
+            self._started = True
+            self._cond.notify_all()
+
+    def wait_started(self):
+        """True once the leader has a response; False if it failed or took too long."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._started, self.timeout):
+                return False
+        return self.status is not None
+
+    def iter_chunks(self):
+        index = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: index < len(self._chunks) or self._done, self.timeout)
+                # Done, or the leader stalled: end the follower's copy here
+                if index >= len(self._chunks):
+                    return
+                chunk = self._chunks[index]
+            index += 1
+            yield chunk
+
+
+class RequestCoalescer:
+    """Single-flight: identical in-flight requests share one upstream call."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def join(self, key):
+        """Return (flight, is_leader) for key."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.followers += 1
+                return flight, False
+            flight = self._flights[key] = Flight()
+            return flight, True
+
+    def lead(self, key, flight, response):
+        """Publish the leader's response to the flight while it is relayed.
+
+        The flight is settled when the response is closed, even if relaying
+        failed before the first chunk was pulled.
+        """
+        flight.start(response.status, response.content_type, response.streamed)
+        chunks = iter(response.chunks)
+
+        def pump():
+            for chunk in chunks:
+                flight.append(chunk)
+                yield chunk
+
+        def settle():
+            # Stop new requests joining, then let the others finish even if
+            # the leader's own client went away
+            self._forget(key, flight)
+            try:
+                if flight.followers:
+                    for chunk in chunks:
+                        flight.append(chunk)
+            except Exception:
+                pass
+            finally:
+                flight.finish()
+
+        response.chunks = pump()
+        # Before the upstream connection is released, so the rest can still be read
+        response.add_on_close(settle, first=True)
+
+    def abandon(self, key, flight):
+        """The leader failed before producing a response; release any followers."""
+        self._forget(key, flight)
+        flight.finish()
+
+    def _forget(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+
+class ProxyResponse:
+    """Status, content type and body (an iterator of byte chunks) ready to send.
+
+    Streamed responses are relayed with chunked encoding as chunks arrive;
+    others are joined and sent with a Content-Length. on_close runs once the
+    response has been sent or abandoned.
+    """
+
+    def __init__(self, status, content_type, chunks, streamed=False, on_close=None):
+        self.status = status
+        self.content_type = content_type
+        self.chunks = chunks
+        self.streamed = streamed
+        self._on_close = on_close
+
+    def add_on_close(self, callback, first=False):
+        """Run callback after any existing on_close, or before it if first."""
+        previous = self._on_close
+        if previous is None:
+            self._on_close = callback
+            return
+        before, after = (callback, previous) if first else (previous, callback)
+
+        def on_close():
+            try:
+                before()
+            finally:
+                after()
+
+        self._on_close = on_close
+
+    def close(self):
+        close_chunks = getattr(self.chunks, 'close', None)
+        if close_chunks is not None:
+            close_chunks()
+        if self._on_close is not None:
+            on_close, self._on_close = self._on_close, None
+            on_close()
+
+
+def api_error_response(status, message):
+    error_response = {
+        "type": "error",
+        "error": {
+            "type": ERROR_TYPES.get(status, 'api_error'),
+            "message": message
+        }
+    }
+    return ProxyResponse(status, 'application/json', [json.dumps(error_response).encode()])
+
+
+def new_tool_id():
+    return f"toolu_{uuid.uuid4().hex[:24]}"
+
+
+def system_text(system):
+    """The Anthropic system prompt is either a string or a list of text blocks."""
+    if isinstance(system, str):
+        return system
+    return "\n\n".join(block.get('text', '') for block in system or [] if block.get('type') == 'text')
+
+
+def content_blocks(content):
+    if isinstance(content, str):
+        return [{'type': 'text', 'text': content}]
+    return content or []
+
+
+def tool_result_text(block):
+    content = block.get('content', '')
+    if isinstance(content, str):
+        return content
+    return "\n".join(part.get('text', '') for part in content if part.get('type') == 'text')
+
+
+def parse_tool_arguments(arguments):
+    if isinstance(arguments, dict):
+        return arguments
+    try:
+        value = json.loads(arguments or '{}')
+    except ValueError:
+        return {}
+    return value if isinstance(value, dict) else {}
+
+
+def function_tools(request_data):
+    # Server tools (web search etc.) have no schema and cannot be forwarded
+    return [tool for tool in request_data.get('tools') or [] if tool.get('name') and 'input_schema' in tool]
+
+
+def anthropic_message(model, content, stop_reason, usage):
+    return {
+        "id": f"msg_{uuid.uuid4().hex[:24]}",
+        "type": "message",
+        "role": "assistant",
+        "model": model,
+        "content": content,
+        "stop_reason": stop_reason,
+        "stop_sequence": None,
+        "usage": usage,
+    }
+
+
+def anthropic_to_openai(request_data):
+    """Translate an Anthropic Messages request into an OpenAI chat completions request."""
+    messages = []
+    system = system_text(request_data.get('system'))
+    if system:
+        messages.append({'role': 'system', 'content': system})
+
+    for message in request_data.get('messages', []):
+        parts, tool_calls = [], []
+        for block in content_blocks(message.get('content')):
+            kind = block.get('type')
+            if kind == 'text':
+                parts.append({'type': 'text', 'text': block.get('text', '')})
+            elif kind == 'image':
+                source = block.get('source', {})
+                if source.get('type') == 'url':
+                    url = source.get('url')
+                else:
+                    url = f"data:{source.get('media_type')};base64,{source.get('data')}"
+                parts.append({'type': 'image_url', 'image_url': {'url': url}})
+            elif kind == 'tool_use':
+                tool_calls.append({
+                    'id': block.get('id'),
+                    'type': 'function',
+                    'function': {'name': block.get('name'), 'arguments': json.dumps(block.get('input', {}))},
+                })
+            elif kind == 'tool_result':
+                # Tool messages must directly follow the assistant turn, ahead of any user text
+                messages.append({'role': 'tool', 'tool_call_id': block.get('tool_use_id'),
+                                 'content': tool_result_text(block)})
+            # Thinking blocks have no OpenAI equivalent and are dropped
+
+        if message.get('role') == 'assistant':
+            text = "".join(part['text'] for part in parts if part['type'] == 'text')
+            if text or tool_calls:
+                assistant = {'role': 'assistant', 'content': text or None}
+                if tool_calls:
+                    assistant['tool_calls'] = tool_calls
+                messages.append(assistant)
+        elif parts:
+            if all(part['type'] == 'text' for part in parts):
+                messages.append({'role': 'user', 'content': "\n".join(part['text'] for part in parts)})
+            else:
+                messages.append({'role': 'user', 'content': parts})
+
+    body = {'model': request_data.get('model'), 'messages': messages}
+    for source, target in (('max_tokens', 'max_tokens'), ('temperature', 'temperature'),
+                           ('top_p', 'top_p'), ('stop_sequences', 'stop')):
+        if source in request_data:
+            body[target] = request_data[source]
+
+    tools = function_tools(request_data)
+    if tools:
+        body['tools'] = [{
+            'type': 'function',
+            'function': {'name': tool['name'], 'description': tool.get('description', ''),
+                         'parameters': tool['input_schema']},
+        } for tool in tools]
+        choice = request_data.get('tool_choice') or {}
+        kind = choice.get('type')
+        if kind == 'tool':
+            body['tool_choice'] = {'type': 'function', 'function': {'name': choice.get('name')}}
+        elif kind in OPENAI_TOOL_CHOICES:
+            body['tool_choice'] = OPENAI_TOOL_CHOICES[kind]
+        if choice.get('disable_parallel_tool_use'):
+            body['parallel_tool_calls'] = False
+
+    if request_data.get('stream'):
+        body['stream'] = True
+        body['stream_options'] = {'include_usage': True}
+    return body
+
+
+def openai_usage(usage):
+    usage = usage or {}
+    cached = (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+    return {
+        'input_tokens': (usage.get('prompt_tokens') or 0) - cached,
+        'output_tokens': usage.get('completion_tokens') or 0,
+        'cache_read_input_tokens': cached,
+    }
+
+
+def openai_to_anthropic(body, model):
+    """Translate an OpenAI chat completion into an Anthropic message."""
+    choice = (body.get('choices') or [{}])[0]
+    message = choice.get('message') or {}
+    content = []
+    if message.get('content'):
+        content.append({'type': 'text', 'text': message['content']})
+    for call in message.get('tool_calls') or []:
+        function = call.get('function') or {}
+        content.append({'type': 'tool_use', 'id': call.get('id') or new_tool_id(),
+                        'name': function.get('name', ''), 'input': parse_tool_arguments(function.get('arguments'))})
+    stop_reason = OPENAI_STOP_REASONS.get(choice.get('finish_reason'), 'end_turn')
+    return anthropic_message(model, content, stop_reason, openai_usage(body.get('usage')))
+
+
+def gemini_schema(schema):
+    """Drop the JSON Schema keywords Gemini function declarations reject."""
+    if isinstance(schema, list):
+        return [gemini_schema(item) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    result = {}
+    for key, value in schema.items():
+        if key in GEMINI_UNSUPPORTED_SCHEMA_KEYS:
+            continue
+        if key == 'properties' and isinstance(value, dict):
+            # Property names are user data, not keywords
+            result[key] = {name: gemini_schema(prop) for name, prop in value.items()}
+        else:
+            result[key] = gemini_schema(value)
+    return result
+
+
+def anthropic_to_gemini(request_data):
+    """Translate an Anthropic Messages request into a Gemini generateContent request."""
+    contents = []
+    tool_names = {}
+    for message in request_data.get('messages', []):
+        parts = []
+        for block in content_blocks(message.get('content')):
+            kind = block.get('type')
+            if kind == 'text':
+                parts.append({'text': block.get('text', '')})
+            elif kind == 'image':
+                source = block.get('source', {})
+                if source.get('type') == 'base64':
+                    parts.append({'inlineData': {'mimeType': source.get('media_type'), 'data': source.get('data')}})
+                else:
+                    parts.append({'fileData': {'fileUri': source.get('url')}})
+            elif kind == 'tool_use':
+                tool_names[block.get('id')] = block.get('name')
+                parts.append({'functionCall': {'name': block.get('name'), 'args': block.get('input', {})}})
+            elif kind == 'tool_result':
+                # Gemini matches results to calls by function name
+                name = tool_names.get(block.get('tool_use_id'), block.get('tool_use_id'))
+                key = 'error' if block.get('is_error') else 'content'
+                parts.append({'functionResponse': {'name': name, 'response': {key: tool_result_text(block)}}})
+        if parts:
+            contents.append({'role': 'model' if message.get('role') == 'assistant' else 'user', 'parts': parts})
+
+    body = {'contents': contents}
+    system = system_text(request_data.get('system'))
+    if system:
+        body['systemInstruction'] = {'parts': [{'text': system}]}
+
+    config = {}
+    for source, target in (('max_tokens', 'maxOutputTokens'), ('temperature', 'temperature'),
+                           ('top_p', 'topP'), ('top_k', 'topK'), ('stop_sequences', 'stopSequences')):
+        if source in request_data:
+            config[target] = request_data[source]
+    if config:
+        body['generationConfig'] = config
+
+    declarations = []
+    for tool in function_tools(request_data):
+        declaration = {'name': tool['name'], 'description': tool.get('description', '')}
+        # Gemini rejects object schemas without properties
+        if tool['input_schema'].get('properties'):
+            declaration['parameters'] = gemini_schema(tool['input_schema'])
+        declarations.append(declaration)
+    if declarations:
+        body['tools'] = [{'functionDeclarations': declarations}]
+        choice = request_data.get('tool_choice') or {}
+        kind = choice.get('type')
+        if kind in GEMINI_TOOL_MODES:
+            calling = {'mode': GEMINI_TOOL_MODES[kind]}
+            if kind == 'tool':
+                calling['allowedFunctionNames'] = [choice.get('name')]
+            body['toolConfig'] = {'functionCallingConfig': calling}
+    return body
+
+
+def gemini_usage(metadata):
+    metadata = metadata or {}
+    cached = metadata.get('cachedContentTokenCount') or 0
+    return {
+        'input_tokens': (metadata.get('promptTokenCount') or 0) - cached,
+        'output_tokens': (metadata.get('candidatesTokenCount') or 0) + (metadata.get('thoughtsTokenCount') or 0),
+        'cache_read_input_tokens': cached,
+    }
+
+
+def gemini_stop_reason(finish_reason, called_tool):
+    if called_tool:
+        return 'tool_use'
+    return GEMINI_STOP_REASONS.get(finish_reason, 'end_turn')
+
+
+def gemini_to_anthropic(body, model):
+    """Translate a Gemini generateContent response into an Anthropic message."""
+    candidate = (body.get('candidates') or [{}])[0]
+    content = []
+    for part in (candidate.get('content') or {}).get('parts') or []:
+        if part.get('thought'):
+            continue
+        if 'text' in part:
+            content.append({'type': 'text', 'text': part['text']})
+        elif 'functionCall' in part:
+            call = part['functionCall']
+            content.append({'type': 'tool_use', 'id': new_tool_id(),
+                            'name': call.get('name', ''), 'input': call.get('args') or {}})
+    called_tool = any(block['type'] == 'tool_use' for block in content)
+    return anthropic_message(model, content, gemini_stop_reason(candidate.get('finishReason'), called_tool),
+                             gemini_usage(body.get('usageMetadata')))
+
+
+def iter_sse_data(chunks):
+    """Yield the data payload of each server-sent event in a stream of byte chunks."""
+    buffer = b''
+    for chunk in chunks:
+        buffer += chunk
+        *events, buffer = buffer.replace(b'\r\n', b'\n').split(b'\n\n')
+        for event in events:
+            data = [line[5:].lstrip(b' ') for line in event.split(b'\n') if line.startswith(b'data:')]
+            if data:
+                yield b'\n'.join(data)
+    data = [line[5:].lstrip(b' ') for line in buffer.split(b'\n') if line.startswith(b'data:')]
+    if data:
+        yield b'\n'.join(data)
+
+
+class AnthropicStreamWriter:
+    """Turns incremental text and tool call pieces into Anthropic SSE events.
+
+    Each method returns the encoded events it produced; content blocks are
+    opened and closed as the kind of output changes. message_start reports
+    input_tokens, an estimate until the upstream's own count is known; the
+    final message_delta carries the upstream's usage.
+    """
+
+    def __init__(self, model, input_tokens=0):
+        self.model = model
+        self.index = -1
+        self.block_type = None
+        self.started = False
+        self.usage = {'input_tokens': input_tokens, 'output_tokens': 0}
+
+    def start_usage(self, usage):
+        """Report the upstream's prompt counts in message_start, if it has not been sent yet."""
+        if not self.started:
+            self.usage = dict(usage, output_tokens=0)
+
+    def start(self):
+        if self.started:
+            return []
+        self.started = True
+        message = anthropic_message(self.model, [], None, self.usage)
+        return [sse_event('message_start', {'type': 'message_start', 'message': message})]
+
+    def open_block(self, block):
+        events = self.start() + self.close_block()
+        self.index += 1
+        self.block_type = block['type']
+        events.append(sse_event('content_block_start',
+                                {'type': 'content_block_start', 'index': self.index, 'content_block': block}))
+        return events
+
+    def close_block(self):
+        if self.block_type is None:
+            return []
+        self.block_type = None
+        return [sse_event('content_block_stop', {'type': 'content_block_stop', 'index': self.index})]
+
+    def text(self, text):
+        events = self.open_block({'type': 'text', 'text': ''}) if self.block_type != 'text' else []
+        events.append(sse_event('content_block_delta', {
+            'type': 'content_block_delta', 'index': self.index,
+            'delta': {'type': 'text_delta', 'text': text}}))
+        return events
+
+    def tool_use(self, tool_id, name):
+        return self.open_block({'type': 'tool_use', 'id': tool_id, 'name': name, 'input': {}})
+
+    def tool_input(self, partial_json):
+        return [sse_event('content_block_delta', {
+            'type': 'content_block_delta', 'index': self.index,
+            'delta': {'type': 'input_json_delta', 'partial_json': partial_json}})]
+
+    def finish(self, stop_reason, usage):
+        events = self.start() + self.close_block()
+        events.append(sse_event('message_delta', {
+            'type': 'message_delta', 'delta': {'stop_reason': stop_reason, 'stop_sequence': None}, 'usage': usage}))
+        events.append(sse_event('message_stop', {'type': 'message_stop'}))
+        return events
+
+    @staticmethod
+    def error(message):
+        return sse_event('error', {'type': 'error', 'error': {'type': 'api_error', 'message': message}})
+
+
+def stream_error_message(event):
+    error = event.get('error')
+    if isinstance(error, dict):
+        return error.get('message') or json.dumps(error)
+    return str(error)
+
+
+def translate_openai_stream(chunks, model, input_tokens=0):
+    """Translate an OpenAI chat completions SSE stream into Anthropic SSE events.
+
+    OpenAI only reports usage in the last chunk, so message_start carries the
+    input_tokens estimate.
+    """
+    writer = AnthropicStreamWriter(model, input_tokens)
+    stop_reason, usage = 'end_turn', None
+    started_calls = set()
+    for data in iter_sse_data(chunks):
+        if data == b'[DONE]':
+            break
+        try:
+            event = json.loads(data)
+        except ValueError:
+            continue
+        if event.get('error'):
+            yield AnthropicStreamWriter.error(stream_error_message(event))
+            return
+        usage = event.get('usage') or usage
+        if event.get('usage'):
+            writer.start_usage(openai_usage(usage))
+        events = []
+        for choice in event.get('choices') or []:
+            delta = choice.get('delta') or {}
+            if delta.get('content'):
+                events += writer.text(delta['content'])
+            for call in delta.get('tool_calls') or []:
+                function = call.get('function') or {}
+                index = call.get('index', 0)
+                if index not in started_calls:
+                    started_calls.add(index)
+                    events += writer.tool_use(call.get('id') or new_tool_id(), function.get('name', ''))
+                if function.get('arguments'):
+                    events += writer.tool_input(function['arguments'])
+            if choice.get('finish_reason'):
+                stop_reason = OPENAI_STOP_REASONS.get(choice['finish_reason'], 'end_turn')
+        if events:
+            yield b''.join(events)
+    # Without upstream usage, keep the estimate rather than report no input at all
+    yield b''.join(writer.finish(stop_reason, openai_usage(usage) if usage else writer.usage))
+
+
+def translate_gemini_stream(chunks, model, input_tokens=0):
+    """Translate a Gemini streamGenerateContent SSE stream into Anthropic SSE events.
+
+    Gemini reports the prompt size with the first chunk, which message_start
+    then uses instead of the input_tokens estimate.
+    """
+    writer = AnthropicStreamWriter(model, input_tokens)
+    finish_reason, usage, called_tool = None, None, False
+    for data in iter_sse_data(chunks):
+        try:
+            event = json.loads(data)
+        except ValueError:
+            continue
+        if event.get('error'):
+            yield AnthropicStreamWriter.error(stream_error_message(event))
+            return
+        usage = event.get('usageMetadata') or usage
+        if event.get('usageMetadata'):
+            writer.start_usage(gemini_usage(usage))
+        events = []
+        for candidate in (event.get('candidates') or [])[:1]:
+            for part in (candidate.get('content') or {}).get('parts') or []:
+                if part.get('thought'):
+                    continue
+                if part.get('text'):
+                    events += writer.text(part['text'])
+                elif 'functionCall' in part:
+                    # Gemini sends each call whole rather than as argument deltas
+                    call = part['functionCall']
+                    called_tool = True
+                    events += writer.tool_use(new_tool_id(), call.get('name', ''))
+                    events += writer.tool_input(json.dumps(call.get('args') or {}))
+            finish_reason = candidate.get('finishReason') or finish_reason
+        if events:
+            yield b''.join(events)
+    yield b''.join(writer.finish(gemini_stop_reason(finish_reason, called_tool),
+                                 gemini_usage(usage) if usage else writer.usage))
+
+
+TRANSLATORS = {
+    # format: (request, response, stream)
+    'openai': (anthropic_to_openai, openai_to_anthropic, translate_openai_stream),
+    'gemini': (anthropic_to_gemini, gemini_to_anthropic, translate_gemini_stream),
+}
+
+
+def translated_request_url(upstream_format, base_url, request_data):
+    if upstream_format == 'openai':
+        return f"{base_url}/chat/completions"
+    model = str(request_data.get('model', ''))
+    model = urllib.parse.quote(model[len('models/'):] if model.startswith('models/') else model, safe='')
+    action = 'streamGenerateContent?alt=sse' if request_data.get('stream') else 'generateContent'
+    return f"{base_url}/models/{model}:{action}"
+
+
+def translated_error_response(status, body):
+    """Re-shape an OpenAI or Gemini error body as an Anthropic error."""
+    try:
+        error = json.loads(body)
+    except ValueError:
+        error = None
+    if isinstance(error, list) and error:
+        error = error[0]
+    error = error.get('error') if isinstance(error, dict) else None
+    if isinstance(error, dict):
+        message = error.get('message') or json.dumps(error)
+    elif isinstance(error, str):
+        message = error
+    else:
+        message = body.decode('utf-8', 'replace')[:1000] or f"Upstream returned HTTP {status}"
+    return api_error_response(status, message)
+
+
+def estimated_tokens_response(request_data):
+    # Translated upstreams have no token counting endpoint; roughly 4 bytes per token
+    size = len(json.dumps([request_data.get('system'), request_data.get('messages'), request_data.get('tools')]))
+    return ProxyResponse(200, 'application/json', [json.dumps({'input_tokens': max(1, size // 4)}).encode()])
+
+
+def add_cache_breakpoints(request_data):
+    """Mark the stable prompt prefix as cacheable; returns (request, breakpoints added).
+
+    Breakpoints go after the tool definitions, the system prompt and the
+    superpowers skill bootstrap in the first user message, in that order,
+    once the prefix up to them is long enough to be cached. Places the client
+    already marked are kept, and the total stays within the API's limit. An
+    added breakpoint takes the longest ttl the client set on any later one.
+    """
+    tools = request_data.get('tools') or []
+    system = request_data.get('system') or []
+    if isinstance(system, str):
+        system = [{'type': 'text', 'text': system}]
+    messages = request_data.get('messages') or []
+    first = messages[0] if messages and messages[0].get('role') == 'user' else {}
+    content = first.get('content') if isinstance(first.get('content'), list) else []
+
+    blocks = tools + system + [block for message in messages for block in content_blocks(message.get('content'))]
+    budget = MAX_CACHE_BREAKPOINTS - sum(1 for block in blocks if isinstance(block, dict) and 'cache_control' in block)
+    bootstrap = next((index for index, block in enumerate(content) if block.get('type') == 'text'
+                      and SKILL_BOOTSTRAP_MARKER in block.get('text', '')), None)
+
+    # Client breakpoints as (position in blocks, ttl), to keep ttls non-increasing
+    marked = [(position, block['cache_control'].get('ttl', '5m')) for position, block in enumerate(blocks)
+              if isinstance(block, dict) and isinstance(block.get('cache_control'), dict)]
+    offsets = {'tools': 0, 'system': len(tools), 'content': len(tools) + len(system)}
+
+    changes = {}
+    prefix_size = 0
+    for field, items, index in (('tools', tools, len(tools) - 1), ('system', system, len(system) - 1),
+                                ('content', content, bootstrap)):
+        if index is None or index < 0:
+            continue
+        prefix_size += len(json.dumps(items[:index + 1]))
+        if budget <= 0 or 'cache_control' in items[index] or prefix_size // 4 < PROMPT_CACHE_MIN_TOKENS:
+            continue
+        later = [ttl for position, ttl in marked if position > offsets[field] + index]
+        ttl = max(later, key=lambda value: CACHE_TTLS.get(value, 0), default='5m')
+        items = list(items)
+        control = CACHE_CONTROL if ttl == '5m' else dict(CACHE_CONTROL, ttl=ttl)
+        items[index] = dict(items[index], cache_control=control)
+        changes[field] = items
+        budget -= 1
+
+    if not changes:
+        return request_data, 0
+    updated = dict(request_data)
+    if 'tools' in changes:
+        updated['tools'] = changes['tools']
+    if 'system' in changes:
+        updated['system'] = changes['system']
+    if 'content' in changes:
+        updated['messages'] = [dict(first, content=changes['content'])] + messages[1:]
+    return updated, len(changes)
+
+
+def observe_usage(chunks, record):
+    """Relay Anthropic response chunks, then call record(usage) with the usage they reported.
+
+    Works for JSON bodies and SSE streams alike: every "usage" object is
+    merged, so both message_start's counts and message_delta's final ones count.
+    """
+    usage = {}
+    pending = b''
+    decoder = json.JSONDecoder()
+    try:
+        for chunk in chunks:
+            yield chunk
+            data = pending + chunk if pending else chunk
+            start = data.find(USAGE_KEY)
+            while start != -1:
+                text = data[start + len(USAGE_KEY):].decode('utf-8', 'replace').lstrip()
+                try:
+                    value, _ = decoder.raw_decode(text)
+                except ValueError:
+                    # Cut off at the chunk boundary; finish it with the next chunk
+                    pending = data[start:] if len(data) - start < STREAM_CHUNK_SIZE else b''
+                    break
+                if isinstance(value, dict):
+                    usage.update(value)
+                start = data.find(USAGE_KEY, start + len(USAGE_KEY))
+            else:
+                # The key itself may straddle two chunks
+                pending = data[-len(USAGE_KEY) + 1:]
+    finally:
+        if usage:
+            record(usage)
+
+
+def prefix_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+class GeminiContextCache:
+    """Explicit Gemini context caches for repeated system prompt and tool prefixes.
+
+    A prefix of at least GEMINI_CACHE_MIN_TOKENS seen twice within the TTL
+    gets a cachedContents resource, and later requests with the same prefix
+    and credentials reference it instead of resending it. Prefixes Gemini
+    refuses to cache are not tried again until the TTL has passed.
+    """
+
+    def __init__(self, pool, ttl=GEMINI_CACHE_TTL):
+        self.pool = pool
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> [expires (monotonic), cachedContents name or None, times seen]
+        self._entries = {}
+
+    def apply(self, base_url, headers, model, gemini_request):
+        """Returns (request to send, key to forget if the upstream rejects it, or None)."""
+        prefix = {field: gemini_request[field] for field in GEMINI_CACHED_FIELDS if field in gemini_request}
+        if 'systemInstruction' not in prefix or len(json.dumps(prefix)) // 4 < GEMINI_CACHE_MIN_TOKENS:
+            return gemini_request, None
+        credentials = [headers.get('Authorization'), headers.get('X-Goog-Api-Key')]
+        key = prefix_key(model, credentials, prefix)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                entry = self._entries[key] = [now + self.ttl, None, 0]
+            entry[2] += 1
+            name, create = entry[1], entry[1] is None and entry[2] == 2
+            if len(self._entries) > DEFAULT_CACHE_ENTRIES:
+                self._entries = {k: e for k, e in self._entries.items() if e[0] > now}
+        if create:
+            name = self._create(base_url, headers, model, prefix)
+            with self._lock:
+                entry[1] = name
+                if name is None:
+                    entry[0] = now + self.ttl
+                else:
+                    entry[0] = time.monotonic() + self.ttl - GEMINI_CACHE_MARGIN
+        if name is None:
+            return gemini_request, None
+        request = {field: value for field, value in gemini_request.items() if field not in GEMINI_CACHED_FIELDS}
+        request['cachedContent'] = name
+        return request, key
+
+    def forget(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _create(self, base_url, headers, model, prefix):
+        body = dict(prefix, model=f"models/{model}", ttl=f"{self.ttl}s")
+        try:
+            with self.pool.request('POST', f"{base_url}/cachedContents", body=json.dumps(body).encode(),
+                                   headers=headers) as response:
+                data = response.read()
+                if response.status >= 400:
+                    return None
+            return json.loads(data).get('name')
+        except Exception:
+            return None
+
+
+class MetricsShard:
+    """Counters and histograms written by one handler thread at a time.
+
+    Shards are checked out per connection, so the hot path is plain dict
+    updates with no lock; /metrics sums all shards when scraped.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.in_flight = 0
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            # Per-bucket counts (last one is +Inf), then sum and count
+            histogram = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 3)
+        histogram[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+class Metrics:
+    """Prometheus-style metrics aggregated from per-connection shards."""
+
+    def __init__(self):
+        self._free = queue.SimpleQueue()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def borrow(self):
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            shard = MetricsShard()
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def give_back(self, shard):
+        self._free.put(shard)
+
+    def render(self):
+        with self._lock:
+            shards = list(self._shards)
+
+        counters, histograms, in_flight = {}, {}, 0
+        for shard in shards:
+            in_flight += shard.in_flight
+            # dict.copy() is atomic, so a shard being written to is still safe to read
+            for key, value in shard.counters.copy().items():
+                counters[key] = counters.get(key, 0) + value
+            for key, values in shard.histograms.copy().items():
+                total = histograms.setdefault(key, [0] * len(values))
+                for i, value in enumerate(list(values)):
+                    total[i] += value
+
+        lines = [
+            f"# HELP {METRICS_PREFIX}_in_flight Requests currently being handled",
+            f"# TYPE {METRICS_PREFIX}_in_flight gauge",
+            f"{METRICS_PREFIX}_in_flight {in_flight}",
+        ]
+        for name, (kind, help_text) in METRICS_HELP.items():
+            if kind == 'counter':
+                series = sorted((labels, value) for (n, labels), value in counters.items() if n == name)
+                lines.append(f"# HELP {METRICS_PREFIX}_{name} {help_text}")
+                lines.append(f"# TYPE {METRICS_PREFIX}_{name} counter")
+                for labels, value in series:
+                    lines.append(f"{METRICS_PREFIX}_{name}{format_labels(labels)} {value}")
+            else:
+                series = sorted((labels, values) for (n, labels), values in histograms.items() if n == name)
+                lines.append(f"# HELP {METRICS_PREFIX}_{name} {help_text}")
+                lines.append(f"# TYPE {METRICS_PREFIX}_{name} histogram")
+                for labels, values in series:
+                    cumulative = 0
+                    for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), values[:-2]):
+                        cumulative += count
+                        bucket_labels = labels + (('le', str(bound)),)
+                        lines.append(f"{METRICS_PREFIX}_{name}_bucket{format_labels(bucket_labels)} {cumulative}")
+                    lines.append(f"{METRICS_PREFIX}_{name}_sum{format_labels(labels)} {values[-2]:.6f}")
+                    lines.append(f"{METRICS_PREFIX}_{name}_count{format_labels(labels)} {values[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label_value(value)}"' for key, value in labels) + '}'
+
+
+class AntiGravityProxyHandler(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1 is required for chunked streaming and lets clients keep connections alive
+    protocol_version = 'HTTP/1.1'
+    # Streams are many small writes; Nagle plus delayed ACKs would hold each one ~40ms
+    disable_nagle_algorithm = True
+    # Idle keep-alive connections are closed instead of holding a thread forever
+    timeout = KEEPALIVE_TIMEOUT
+
+    def setup(self):
+        super().setup()
+        self.metrics = self.server.metrics.borrow()
+        self._first_byte_at = None
+        self._bytes_out = 0
+        self._status = None
+
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            self.server.metrics.give_back(self.metrics)
+
+    def end_headers(self):
+        # send_error has already said Connection: close
+        if not self.server.keep_alive and not self.close_connection:
+            self.send_header('Connection', 'close')
+        super().end_headers()
+
+    def do_GET(self):
+        if self.path == '/health':
+            response = {"status": "ok", "service": "antigravity-proxy"}
+            if self.server.router is not None:
+                response["providers"] = self.server.router.snapshot()
+            self.send_body(200, 'application/json', json.dumps(response).encode())
+        elif self.path == '/metrics':
+            self.send_body(200, 'text/plain; version=0.0.4', self.server.metrics.render().encode())
+        elif self.path == '/':
+            # Simple UI
+            self.send_body(200, 'text/html', INDEX_HTML.encode())
         else:
             self.send_error(404)
 
@@ -69,82 +2068,649 @@ class AntiGravityProxyHandler(http.server.BaseHTTPRequestHandler):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_body(self, status, content_type, body, extra_headers=None):
+        self.send_response(status)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self._status = status
+        self.write_body(body)
+
+    def write_body(self, data, payload_size=None):
+        if self._first_byte_at is None:
+            self._first_byte_at = time.monotonic()
+        self.wfile.write(data)
+        self._bytes_out += len(data) if payload_size is None else payload_size
+
+    def send_api_error(self, status, message):
+        self.send_proxy_response(api_error_response(status, message))
+
+    def relay_chunks(self, status, content_type, chunks, extra_headers=None):
+        """Send chunks to the client with chunked transfer encoding as they are produced."""
+        self.send_response(status)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Content-Type', content_type)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
         self.end_headers()
+        self._status = status
+        try:
+            for chunk in chunks:
+                if chunk:
+                    self.write_body(b"%X\r\n%s\r\n" % (len(chunk), chunk), len(chunk))
+                    self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # Client went away mid-stream; stop pulling from the source
+            self.close_connection = True
+
+    def send_proxy_response(self, response, extra_headers=None):
+        try:
+            if response.streamed:
+                self.relay_chunks(response.status, response.content_type, response.chunks, extra_headers)
+            else:
+                self.send_body(response.status, response.content_type, b''.join(response.chunks), extra_headers)
+        finally:
+            response.close()
 
     def handle_anthropic_api(self):
-        # Handle Anthropic-compatible API
-        content_length = int(self.headers.get('Content-Length', 0))
-        post_data = self.rfile.read(content_length)
+        # Only API work takes a slot; /health and /metrics must answer under load
+        slots = self.server.request_slots
+        if slots is None:
+            self.serve_anthropic_api()
+            return
+        with slots:
+            self.serve_anthropic_api()
+
+    def serve_anthropic_api(self):
+        started = time.monotonic()
+        self._first_byte_at = None
+        self._bytes_out = 0
+        self._status = None
+        self.metrics.in_flight += 1
+        model = 'unknown'
+        try:
+            model = self.proxy_anthropic_api()
+        except Exception as e:
+            if self._status is None:
+                self.send_api_error(500, str(e))
+            else:
+                # Too late for an error response; drop the half-sent one
+                self.close_connection = True
+        finally:
+            self.metrics.in_flight -= 1
+            labels = (('model', model),)
+            finished = time.monotonic()
+            self.metrics.inc('requests_total', (('model', model), ('status', str(self._status))))
+            self.metrics.inc('bytes_out_total', labels, self._bytes_out)
+            self.metrics.observe('request_duration_seconds', labels, finished - started)
+            if self._first_byte_at is not None:
+                self.metrics.observe('time_to_first_byte_seconds', labels, self._first_byte_at - started)
+
+    def proxy_anthropic_api(self):
+        """Handle Anthropic-compatible API; returns the model name for metrics."""
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            content_length = -1
+        if content_length < 0:
+            self.send_api_error(400, "Invalid Content-Length")
+            return 'unknown'
+        max_body_size = self.server.options.max_body_mb * MB
+        if max_body_size and content_length > max_body_size:
+            # The body is left unread, so this connection cannot be reused
+            self.send_proxy_response(
+                api_error_response(413, f"Request body of {content_length} bytes exceeds the "
+                                        f"{self.server.options.max_body_mb} MB limit"),
+                {'Connection': 'close'})
+            return 'unknown'
+        try:
+            post_data = read_body(self.rfile, content_length)
+        except ConnectionError:
+            self.close_connection = True
+            return 'unknown'
 
         try:
-            request_data = json.loads(post_data.decode())
+            request_data = json.loads(post_data)
+        except Exception as e:
+            self.send_api_error(400, f"Invalid JSON body: {e}")
+            return 'unknown'
+        if not isinstance(request_data, dict):
+            self.send_api_error(400, "Request body must be a JSON object")
+            return 'unknown'
+
+        model = str(request_data.get('model', 'unknown'))
+        self.metrics.inc('bytes_in_total', (('model', model),), len(post_data))
+
+        cache = self.server.response_cache
+        coalescer = self.server.coalescer
+        if urllib.parse.urlsplit(self.path).path not in IDEMPOTENT_PATHS:
+            # Other POST endpoints may have side effects, so each call goes upstream
+            cache = coalescer = None
+        request_key = None
+        if cache is not None or coalescer is not None:
+            # Requests made with different client credentials never share responses
+            variant = "\n".join([self.path] + [self.headers.get(name, '') for name in KEY_HEADERS])
+            request_key = request_cache_key(variant, request_data)
+
+        cache_key = None
+        if cache is not None and is_deterministic(request_data):
+            cache_key = request_key
+            cached = cache.get(cache_key)
+            self.metrics.inc('cache_requests_total', (('result', 'hit' if cached else 'miss'),))
+            if cached is not None:
+                content_type, body = cached
+                self.send_body(200, content_type, body, {'X-Cache': 'HIT'})
+                return model
+
+        extra_headers = {'X-Cache': 'MISS'} if cache_key is not None else {}
+        flight = None
+        if coalescer is not None:
+            flight, is_leader = coalescer.join(request_key)
+            if not is_leader:
+                if flight.wait_started():
+                    self.metrics.inc('coalesced_requests_total', (('model', model),))
+                    extra_headers['X-Coalesced'] = 'true'
+                    response = ProxyResponse(flight.status, flight.content_type, flight.iter_chunks(),
+                                             streamed=flight.streamed)
+                    self.send_proxy_response(response, extra_headers)
+                    return model
+                # The leader failed outright; make our own request
+                flight = None
+
+        try:
+            response = self.open_response(post_data, request_data)
+        except Exception:
+            if flight is not None:
+                coalescer.abandon(request_key, flight)
+            raise
+        if flight is not None:
+            coalescer.lead(request_key, flight, response)
+        if cache_key is not None and response.status == 200:
+            response.chunks = cache.collect(cache_key, response.content_type, response.chunks)
+        self.send_proxy_response(response, extra_headers)
+        return model
+
+    def open_response(self, post_data, request_data):
+        if self.server.router is not None:
+            return self.open_upstream(post_data, request_data)
+        return self.open_mock(request_data)
+
+    def open_mock(self, request_data):
+        try:
             messages = request_data.get('messages', [])
             model = request_data.get('model', 'gemini-2.0-flash')
+            message_id = f"msg_{datetime.now().timestamp()}"
+            text = mock_response_text(model, messages)
+        except Exception as e:
+            return api_error_response(500, str(e))
+
+        if request_data.get('stream'):
+            return ProxyResponse(200, 'text/event-stream', iter_mock_sse(message_id, model, text), streamed=True)
 
-            # Set CORS headers
-            self.send_response(200)
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-
-            # For now, return a mock response
-            # In production, this would call the actual AntiGravity API
-            response = {
-                "id": f"msg_{datetime.now().timestamp()}",
-                "type": "message",
-                "role": "assistant",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": f"[AntiGravity Proxy] Received request for model: {model}\n\nThis is a proxy response. The actual implementation would:\n1. Authenticate with Google internal systems\n2. Route to AntiGravity API\n3. Return the real model response\n\nYour message: {messages[-1]['content'] if messages else 'No message'}"
-                    }
-                ],
-                "model": model,
-                "stop_reason": "end_turn",
-                "stop_sequence": None,
-                "usage": {
-                    "input_tokens": 10,
-                    "output_tokens": 50
+        response = {
+            "id": message_id,
+            "type": "message",
+            "role": "assistant",
+            "content": [
+                {
+                    "type": "text",
+                    "text": text
                 }
+            ],
+            "model": model,
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {
+                "input_tokens": 10,
+                "output_tokens": 50
             }
+        }
+        return ProxyResponse(200, 'application/json', [json.dumps(response).encode()])
+
+    def open_upstream(self, post_data, request_data):
+        """Try providers serving the model, best first, failing over on 429, 5xx or no response.
+
+        Once every provider has failed, the best one is retried after a
+        jittered backoff (and at least its Retry-After), up to --retries times.
+        """
+        model = str(request_data.get('model', 'unknown'))
+        router = self.server.router
+        path = urllib.parse.urlsplit(self.path).path
+        candidates = self.serving_candidates(model, path)
+        if not candidates:
+            return api_error_response(404, f"No provider serves model {model}")
+        if candidates[0][0].format in TRANSLATORS and path != '/v1/messages':
+            # Answered here, so it uses none of the provider's rate limit or health stats
+            if path == '/v1/messages/count_tokens':
+                return estimated_tokens_response(request_data)
+            return api_error_response(404, f"{path} is not supported by {candidates[0][0].format} upstreams")
+
+        options = self.server.options
+        idempotent = path in IDEMPOTENT_PATHS
+        tokens = estimate_tokens(post_data)
+        attempt = 0
+        account_retries = 0
+        while True:
+            provider, provider_model = self.admit(candidates, tokens)
+            if provider is None:
+                return api_error_response(429, f"Rate limit queue for {model} timed out; try again shortly")
+            hedge_delay = router.hedge_delay(provider) if options.hedge and idempotent else None
+            if hedge_delay is None:
+                response, status, retry_after = self.try_provider(provider, provider_model, post_data,
+                                                                  request_data)
+            else:
+                response, status, retry_after, provider = self.open_hedged(
+                    provider, provider_model, candidates, tokens, post_data, request_data, hedge_delay)
+            if not is_retryable(status, idempotent):
+                if status is not None and status < 400:
+                    response.chunks = observe_usage(response.chunks,
+                                                    lambda usage, name=provider.name: self.record_usage(name, usage))
+                return response
+            labels = (('provider', provider.name), ('status', str(status or 'connect')))
+            credentials = self.server.credentials
+            if self.account_limited(provider, status) and account_retries < len(credentials.accounts):
+                # Only that account is rate limited; go straight to the next ready one
+                response.close()
+                self.metrics.inc('failovers_total', labels)
+                account_retries += 1
+                candidates.insert(0, (provider, provider_model))
+                continue
+            if candidates:
+                # Nothing has reached the client yet, so the next provider can take over
+                response.close()
+                self.metrics.inc('failovers_total', labels)
+                continue
+            delay = retry_delay(attempt, retry_after, options.max_retry_wait) if attempt < options.retries else None
+            if delay is None:
+                return response
+            response.close()
+            self.metrics.inc('retries_total', labels)
+            time.sleep(delay)
+            attempt += 1
+            candidates = self.serving_candidates(model, path)
+
+    def serving_candidates(self, model, path):
+        """router.candidates for model; only Anthropic upstreams, if any, for endpoints other than messages."""
+        candidates = self.server.router.candidates(model)
+        if path == '/v1/messages':
+            return candidates
+        native = [(provider, name) for provider, name in candidates if provider.format not in TRANSLATORS]
+        return native or candidates
+
+    def record_usage(self, provider_name, usage):
+        """Count how much of the prompt was read from, or written to, the provider's prompt cache."""
+        read = usage.get('cache_read_input_tokens') or 0
+        written = usage.get('cache_creation_input_tokens') or 0
+        labels = (('provider', provider_name),)
+        self.metrics.inc('prompt_cache_requests_total',
+                         labels + (('result', 'hit' if read else 'write' if written else 'miss'),))
+        for kind, tokens in (('read', read), ('write', written), ('uncached', usage.get('input_tokens') or 0)):
+            self.metrics.inc('prompt_cache_tokens_total', labels + (('type', kind),), tokens)
+
+    def try_provider(self, provider, provider_model, post_data, request_data, metrics=None):
+        """One attempt on a provider already admitted by its rate limiter, recorded in its health.
+
+        The concurrency slot is held until the response has been relayed or closed.
+        """
+        metrics = metrics or self.metrics
+        started = time.monotonic()
+        try:
+            response, status, retry_after = self.open_provider(provider, provider_model, post_data,
+                                                               request_data, metrics)
+        except BaseException:
+            provider.limiter.release()
+            raise
+        # Only message latency is comparable across requests, for ranking and hedging
+        latency = time.monotonic() - started if urllib.parse.urlsplit(self.path).path == '/v1/messages' else None
+        if not self.account_limited(provider, status):
+            self.server.router.record(provider, status, latency, retry_after)
+            provider.limiter.feedback(status, retry_after)
+        metrics.inc('provider_requests_total', (('provider', provider.name), ('status', str(status or 'connect'))))
+        response.add_on_close(provider.limiter.release)
+        return response, status, retry_after
+
+    def account_limited(self, provider, status):
+        """Whether a 429 only concerns the account that got it, because another account is ready.
+
+        The account is already cooling down; the provider's health, rate
+        limiter and backoff are left alone.
+        """
+        credentials = self.server.credentials
+        return (status == 429 and provider.use_accounts and credentials is not None
+                and credentials.has_ready())
+
+    def open_hedged(self, provider, provider_model, candidates, tokens, post_data, request_data, delay):
+        """Like try_provider, but start a second attempt elsewhere if the first is slower than delay.
+
+        Returns (response, status, retry_after, provider) for whichever answers
+        first, preferring a success; the other attempt is closed.
+        """
+        providers = [provider]
+        race = HedgedRequest(self.server.metrics)
+        race.start(self.try_provider, provider, provider_model, post_data, request_data)
+        try:
+            result = race.wait(delay)
+            if result is None:
+                second, second_model = self.hedge_target(provider, provider_model, candidates, tokens)
+                if second is not None:
+                    self.metrics.inc('hedged_requests_total', (('provider', second.name),))
+                    providers.append(second)
+                    race.start(self.try_provider, second, second_model, post_data, request_data)
+                result = race.wait()
+                if race.pending and ProviderRouter.is_failure(result[1]):
+                    # The other attempt may still succeed
+                    result[0].close()
+                    result = race.wait()
+                if result[3] == 1:
+                    self.metrics.inc('hedge_wins_total', (('provider', second.name),))
+            response, status, retry_after, index = result
+            return response, status, retry_after, providers[index]
+        finally:
+            race.finish()
 
-            self.wfile.write(json.dumps(response).encode())
+    def hedge_target(self, provider, provider_model, candidates, tokens):
+        """A (provider, provider model) pair with rate limit headroom for a hedge, or (None, None).
 
+        Another provider is preferred; a provider on the account pool can also
+        hedge with a second account.
+        """
+        for index, (candidate, candidate_model) in enumerate(candidates):
+            if candidate.limiter.acquire(tokens, 0) is not None:
+                del candidates[index]
+                return candidate, candidate_model
+        credentials = self.server.credentials
+        if (provider.use_accounts and credentials is not None and len(credentials.accounts) > 1
+                and provider.limiter.acquire(tokens, 0) is not None):
+            return provider, provider_model
+        return None, None
+
+    def admit(self, candidates, tokens):
+        """Take the best candidate with rate limit headroom, queueing on the best one if none has any.
+
+        The chosen pair is removed from candidates; (None, None) if the queue timed out.
+        """
+        for index, (provider, provider_model) in enumerate(candidates):
+            if provider.limiter.acquire(tokens, 0) is not None:
+                del candidates[index]
+                return provider, provider_model
+        provider, provider_model = candidates.pop(0)
+        waited = provider.limiter.acquire(tokens, self.server.options.queue_timeout)
+        labels = (('provider', provider.name),)
+        if waited is None:
+            self.metrics.inc('queue_timeouts_total', labels)
+            return None, None
+        self.metrics.observe('queue_wait_seconds', labels, waited)
+        return provider, provider_model
+
+    def open_provider(self, provider, provider_model, post_data, request_data, metrics):
+        """Start the request on one provider; returns (response, upstream status or None, Retry-After).
+
+        The upstream body is relayed chunk by chunk as it arrives.
+        """
+        model = str(request_data.get('model', 'unknown'))
+        if provider_model != model:
+            request_data = dict(request_data, model=provider_model)
+            post_data = None
+        translator = TRANSLATORS.get(provider.format)
+        path = urllib.parse.urlsplit(self.path).path
+        prompt_cache = provider.prompt_cache and not self.server.options.no_prompt_cache
+        upstream_request = None
+        if translator is None:
+            url = provider.base_url + self.path
+            headers = {name: self.headers[name] for name in FORWARDED_HEADERS if self.headers.get(name)}
+            if prompt_cache and path == '/v1/messages':
+                request_data, added = add_cache_breakpoints(request_data)
+                if added:
+                    metrics.inc('prompt_cache_breakpoints_total', (('provider', provider.name),), added)
+                    post_data = None
+            if post_data is None:
+                post_data = json.dumps(request_data).encode()
+            if provider.api_key:
+                headers.pop('Authorization', None)
+                headers['X-Api-Key'] = provider.api_key
+        else:
+            url = translated_request_url(provider.format, provider.base_url, request_data)
+            upstream_request = translator[0](request_data)
+            headers = self.translated_headers(provider.format, provider.api_key)
+
+        credentials = self.server.credentials if provider.use_accounts else None
+        account = credentials.acquire() if credentials is not None else None
+        if account is not None:
+            # The proxy owns upstream auth; drop whatever placeholder key the client sent
+            headers.pop('X-Api-Key', None)
+            headers.pop('X-Goog-Api-Key', None)
+            try:
+                token = account.token_cache.get_token()
+            except Exception as e:
+                credentials.release(account)
+                return api_error_response(401, f"Cannot get an access token for {account.label}: {e}"), 401, None
+            headers['Authorization'] = f"Bearer {token}"
+
+        cache_key = None
+        if upstream_request is not None:
+            if prompt_cache and provider.format == 'gemini':
+                gemini_model = provider_model[len('models/'):] if provider_model.startswith('models/') else provider_model
+                upstream_request, cache_key = self.server.gemini_cache.apply(provider.base_url, headers, gemini_model,
+                                                                             upstream_request)
+            post_data = json.dumps(upstream_request).encode()
+
+        model_labels = (('model', model),)
+        try:
+            upstream = self.server.upstream_pool.request('POST', url, body=post_data, headers=headers)
         except Exception as e:
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            error_response = {
-                "error": {
-                    "type": "api_error",
-                    "message": str(e)
-                }
-            }
-            self.wfile.write(json.dumps(error_response).encode())
+            if account is not None:
+                credentials.release(account)
+            metrics.inc('upstream_errors_total', model_labels + (('status', 'connect'),))
+            return api_error_response(502, f"Upstream request to {provider.name} failed: {e}"), None, None
+        status = upstream.status
+        retry_after = upstream.headers.get('Retry-After')
+        if status == 429 and account is not None:
+            # Bench the account now, so the caller can tell whether another one is ready
+            credentials.rate_limited(account, retry_after)
+        if status >= 400:
+            metrics.inc('upstream_errors_total', model_labels + (('status', str(status)),))
+            if cache_key is not None:
+                # The context cache may have expired early or been deleted
+                self.server.gemini_cache.forget(cache_key)
+
+        def finish():
+            upstream.close()
+            if account is not None:
+                credentials.release(account)
+
+        if translator is None:
+            # Upstream errors are already Anthropic-shaped; pass them through
+            content_type = upstream.headers.get('Content-Type', 'application/json')
+            return ProxyResponse(status, content_type, iter_response_chunks(upstream),
+                                 streamed=True, on_close=finish), status, retry_after
+
+        if status < 400 and request_data.get('stream'):
+            chunks = translator[2](iter_response_chunks(upstream), provider_model, estimate_tokens(post_data))
+            return ProxyResponse(status, 'text/event-stream', chunks, streamed=True,
+                                 on_close=finish), status, retry_after
+        try:
+            body = upstream.read()
+        finally:
+            finish()
+        if status >= 400:
+            return translated_error_response(status, body), status, retry_after
+        try:
+            message = translator[1](json.loads(body), provider_model)
+        except (ValueError, AttributeError) as e:
+            return api_error_response(502, f"Unexpected upstream response: {e}"), 502, None
+        return ProxyResponse(status, 'application/json', [json.dumps(message).encode()]), status, retry_after
+
+    def translated_headers(self, upstream_format, key=None):
+        """Pass the provider's (or else the client's) API key in the form the upstream expects."""
+        key = key or self.headers.get('X-Api-Key')
+        authorization = self.headers.get('Authorization', '')
+        if not key and authorization.lower().startswith('bearer '):
+            key = authorization[len('bearer '):]
+        headers = {'Content-Type': 'application/json'}
+        if key:
+            if upstream_format == 'gemini':
+                headers['X-Goog-Api-Key'] = key
+            else:
+                headers['Authorization'] = f"Bearer {key}"
+        return headers
 
     def log_message(self, format, *args):
         # Suppress logs for cleaner output
         pass
 
-def main():
-    PORT = 8080
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="AntiGravity Proxy Server")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help=f"Port to listen on (default: {DEFAULT_PORT})")
+    parser.add_argument('--mode', choices=['threaded', 'simple'], default='threaded',
+                        help="threaded: concurrent handlers (default); simple: one request at a time")
+    parser.add_argument('--max-concurrency', type=int, default=DEFAULT_MAX_CONCURRENCY,
+                        help=f"Max /v1/* requests handled at once in threaded mode; idle keep-alive "
+                             f"connections, /health and /metrics do not count (default: {DEFAULT_MAX_CONCURRENCY})")
+    parser.add_argument('--backlog', type=int, default=DEFAULT_BACKLOG,
+                        help=f"Listen backlog for pending connections (default: {DEFAULT_BACKLOG})")
+    parser.add_argument('--upstream-format', choices=UPSTREAM_FORMATS, default='anthropic',
+                        help="API spoken by --upstream; openai and gemini requests and responses "
+                             "are translated to and from Anthropic Messages (default: anthropic)")
+    parser.add_argument('--providers-file',
+                        help="JSON list of providers to route between by latency and health, "
+                             "failing over on 429/5xx (see docs/ANTIGRAVITY-SETUP.md)")
+    parser.add_argument('--provider-cooldown', type=int, default=DEFAULT_PROVIDER_COOLDOWN,
+                        help=f"Seconds a provider is skipped after a 5xx or failed connection "
+                             f"(default: {DEFAULT_PROVIDER_COOLDOWN})")
+    parser.add_argument('--rpm', type=int,
+                        help="Requests per minute allowed to --upstream (default: unlimited)")
+    parser.add_argument('--tpm', type=int,
+                        help="Estimated prompt tokens per minute allowed to --upstream (default: unlimited)")
+    parser.add_argument('--provider-concurrency', type=int, default=DEFAULT_MAX_CONCURRENCY,
+                        help=f"Starting and maximum in-flight requests per provider; halved on each 429 "
+                             f"(default: {DEFAULT_MAX_CONCURRENCY})")
+    parser.add_argument('--queue-timeout', type=float, default=DEFAULT_QUEUE_TIMEOUT,
+                        help=f"Seconds a request may wait for a provider rate limit before a 429 "
+                             f"(default: {DEFAULT_QUEUE_TIMEOUT})")
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+                        help=f"Times a request is retried with jittered backoff after every provider "
+                             f"failed with 429/5xx (default: {DEFAULT_RETRIES})")
+    parser.add_argument('--max-retry-wait', type=float, default=DEFAULT_MAX_RETRY_WAIT,
+                        help=f"Give up instead of retrying when Retry-After asks for longer than this "
+                             f"many seconds (default: {DEFAULT_MAX_RETRY_WAIT})")
+    parser.add_argument('--hedge', action='store_true',
+                        help="Send a second request to another provider or account when the first "
+                             "has not answered within the provider's p95 response time")
+    parser.add_argument('--no-prompt-cache', action='store_true',
+                        help="Do not add cache_control breakpoints for Anthropic upstreams or create "
+                             "Gemini context caches")
+    parser.add_argument('--max-body-mb', type=int, default=DEFAULT_MAX_BODY_MB,
+                        help=f"Reject request bodies larger than this with 413, 0 for no limit (default: {DEFAULT_MAX_BODY_MB})")
+    parser.add_argument('--upstream', default=os.environ.get('ANTIGRAVITY_UPSTREAM', ''),
+                        help="Base URL to forward /v1/* to, speaking --upstream-format (default: mock responses)")
+    parser.add_argument('--auth-dir', default=AUTH_DIR,
+                        help=f"Load every *.json credentials file in this directory (default: {AUTH_DIR})")
+    parser.add_argument('--auth-file', action='append',
+                        help="Use only this credentials file; repeat for several accounts")
+    parser.add_argument('--schedule', choices=['least-in-flight', 'round-robin'], default=DEFAULT_SCHEDULE,
+                        help=f"How requests are spread across accounts (default: {DEFAULT_SCHEDULE})")
+    parser.add_argument('--cooldown', type=float, default=DEFAULT_COOLDOWN,
+                        help=f"Seconds an account sits out after a 429 without Retry-After (default: {DEFAULT_COOLDOWN})")
+    parser.add_argument('--refresh-margin', type=int, default=DEFAULT_REFRESH_MARGIN,
+                        help=f"Refresh access tokens this many seconds before expiry (default: {DEFAULT_REFRESH_MARGIN})")
+    parser.add_argument('--coalesce', action='store_true',
+                        help="Share one upstream call between identical message and count_tokens requests in flight together")
+    parser.add_argument('--cache', action='store_true',
+                        help="Cache responses to temperature 0 requests")
+    parser.add_argument('--cache-dir', default=CACHE_DIR,
+                        help=f"Directory for the on-disk cache tier, empty for memory only (default: {CACHE_DIR})")
+    parser.add_argument('--cache-ttl', type=int, default=DEFAULT_CACHE_TTL,
+                        help=f"Seconds a cached response stays valid (default: {DEFAULT_CACHE_TTL})")
+    parser.add_argument('--cache-max-entries', type=int, default=DEFAULT_CACHE_ENTRIES,
+                        help=f"Max responses kept in memory (default: {DEFAULT_CACHE_ENTRIES})")
+    parser.add_argument('--cache-memory-mb', type=int, default=DEFAULT_CACHE_MEMORY_MB,
+                        help=f"Memory tier size limit in MB (default: {DEFAULT_CACHE_MEMORY_MB})")
+    parser.add_argument('--cache-disk-mb', type=int, default=DEFAULT_CACHE_DISK_MB,
+                        help=f"Disk tier size limit in MB (default: {DEFAULT_CACHE_DISK_MB})")
+    parser.add_argument('--pool-size', type=int, default=DEFAULT_POOL_SIZE,
+                        help=f"Max idle upstream connections kept per host; more are opened "
+                             f"whenever needed (default: {DEFAULT_POOL_SIZE})")
+    parser.add_argument('--pool-idle-timeout', type=float, default=DEFAULT_POOL_IDLE_TIMEOUT,
+                        help=f"Seconds an idle upstream connection is kept (default: {DEFAULT_POOL_IDLE_TIMEOUT})")
+    args = parser.parse_args(argv)
+    if args.max_concurrency < 1:
+        parser.error("--max-concurrency must be at least 1")
+    if args.backlog < 1:
+        parser.error("--backlog must be at least 1")
+    if args.retries < 0:
+        parser.error("--retries must not be negative")
+    if args.pool_size < 1:
+        parser.error("--pool-size must be at least 1")
+    return args
+
 
-    # Check if auth exists
-    auth_dir = os.path.expanduser("~/.config/claude-all/antigravity")
-    auth_files = []
-    if os.path.exists(auth_dir):
-        auth_files = [f for f in os.listdir(auth_dir) if f.endswith('.json')]
+def create_server(args, credentials=None, providers=None):
+    address = ("", args.port)
+    if args.mode == 'simple':
+        httpd = SimpleHTTPServer(address, AntiGravityProxyHandler, backlog=args.backlog)
+    else:
+        httpd = BoundedThreadingHTTPServer(address, AntiGravityProxyHandler,
+                                           max_concurrency=args.max_concurrency,
+                                           backlog=args.backlog)
+    httpd.options = args
+    httpd.metrics = Metrics()
+    httpd.upstream_pool = UpstreamPool(max_idle_per_host=args.pool_size,
+                                       idle_timeout=args.pool_idle_timeout)
+    httpd.credentials = credentials
+    if providers is None:
+        providers = load_providers(args)
+    httpd.router = ProviderRouter(providers, cooldown=args.provider_cooldown) if providers else None
+    httpd.gemini_cache = GeminiContextCache(httpd.upstream_pool)
+    httpd.coalescer = RequestCoalescer() if args.coalesce else None
+    httpd.response_cache = None
+    if args.cache:
+        httpd.response_cache = ResponseCache(
+            ttl=args.cache_ttl,
+            max_entries=args.cache_max_entries,
+            memory_bytes=args.cache_memory_mb * MB,
+            disk_bytes=args.cache_disk_mb * MB,
+            path=os.path.join(args.cache_dir, 'responses.sqlite3') if args.cache_dir else None
+        )
+    return httpd
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    PORT = args.port
+
+    # Load every available account into the credential pool
+    credentials = load_credential_pool(args)
+    try:
+        providers = load_providers(args)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"❌ Cannot load providers: {e}", file=sys.stderr)
+        sys.exit(1)
 
     print("=" * 60)
     print("AntiGravity Proxy Server")
     print("=" * 60)
     print(f"Port: {PORT}")
-    print(f"Auth files found: {len(auth_files)}")
+    if args.mode == 'threaded':
+        print(f"Mode: threaded (max concurrency {args.max_concurrency}, backlog {args.backlog})")
+    else:
+        print(f"Mode: simple (backlog {args.backlog})")
+    print(f"Accounts loaded: {len(credentials.accounts) if credentials else 0}")
 
-    if auth_files:
-        print("✓ Authentication files available")
-        for f in auth_files:
-            print(f"  - {f}")
+    if credentials:
+        print(f"✓ Authentication files available (schedule: {credentials.strategy})")
+        for account in credentials.accounts:
+            print(f"  - {os.path.basename(account.token_cache.path)} ({account.label})")
     else:
         print("⚠️  No authentication files found")
         print("  Run: python3 setup_google_internal_auth.py")
@@ -153,16 +2719,37 @@ def main():
     print("Starting server...")
     print(f"URL: http://localhost:{PORT}")
     print(f"API: http://localhost:{PORT}/v1")
+    print(f"Metrics: http://localhost:{PORT}/metrics")
+    if providers:
+        for provider in providers:
+            served = ', '.join(provider.models)
+            print(f"Upstream: {provider.name} {provider.base_url} ({provider.format}; models: {served})")
+    else:
+        print("Upstream: mock responses")
+    if args.coalesce:
+        print("Request coalescing: on")
+    if args.cache:
+        print(f"Response cache: on (ttl {args.cache_ttl}s, {args.cache_dir or 'memory only'})")
     print()
     print("Press Ctrl+C to stop")
     print("=" * 60)
 
-    with socketserver.TCPServer(("", PORT), AntiGravityProxyHandler) as httpd:
+    with create_server(args, credentials, providers) as httpd:
+        refresher = None
+        if credentials is not None:
+            refresher = TokenRefresher(credentials.caches)
+            refresher.start()
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
             print("\nShutting down...")
             httpd.shutdown()
+        finally:
+            if refresher is not None:
+                refresher.stop()
+            httpd.upstream_pool.close()
+            if httpd.response_cache is not None:
+                httpd.response_cache.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
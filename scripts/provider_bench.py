@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+Provider Benchmark
+Fire a prompt set at each configured provider/model concurrently and report
+time to first token, tokens/sec, latency percentiles and error rate.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CATALOG_DIR = os.path.join(REPO_DIR, 'bin')
+RESULTS_DIR = os.path.expanduser("~/.config/claude-all/bench")
+
+DEFAULT_REQUESTS = 5
+DEFAULT_CONCURRENCY = 2
+DEFAULT_MAX_TOKENS = 256
+DEFAULT_TIMEOUT = 120
+DEFAULT_PROMPTS = [
+    "Reply with one short sentence: what is a hash map?",
+    "Write a Python function that reverses a string. Code only.",
+    "List three differences between TCP and UDP as short bullet points.",
+]
+
+# Endpoints claude-all points ANTHROPIC_BASE_URL at, with the API each speaks
+# name: (base URL, format, key environment variable)
+PROVIDERS = {
+    'deepseek': ('https://api.deepseek.com/anthropic', 'anthropic', 'DEEPSEEK_API_KEY'),
+    'minimax': ('https://api.minimax.io/anthropic', 'anthropic', 'MINIMAX_API_KEY'),
+    'glm': ('https://api.z.ai/api/anthropic', 'anthropic', 'GLM_API_KEY'),
+    'gemini': ('https://generativelanguage.googleapis.com/v1beta/openai', 'openai', 'GEMINI_API_KEY'),
+    'groq': ('https://api.groq.com/openai/v1', 'openai', 'GROQ_API_KEY'),
+    'openai': ('https://api.openai.com/v1', 'openai', 'OPENAI_API_KEY'),
+    'xai': ('https://api.x.ai/v1', 'openai', 'XAI_API_KEY'),
+    'mistral': ('https://api.mistral.ai/v1', 'openai', 'MISTRAL_API_KEY'),
+    'moonshot': ('https://api.moonshot.cn/v1', 'openai', 'MOONSHOT_API_KEY'),
+    'openrouter': ('https://openrouter.ai/api/v1', 'openai', 'OPENROUTER_API_KEY'),
+}
+
+
+def load_api_key(provider, key_env):
+    """Key from the environment or claude-all's ~/.<provider>_api_key file."""
+    if os.environ.get(key_env):
+        return os.environ[key_env]
+    try:
+        with open(os.path.expanduser(f"~/.{provider}_api_key")) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def catalog_models(provider):
+    """Model ids listed for provider in bin/<provider>.json, default first."""
+    try:
+        with open(os.path.join(CATALOG_DIR, f"{provider}.json")) as f:
+            catalog = json.load(f)
+    except (OSError, ValueError):
+        return []
+    ids = [m['id'] for m in catalog.get('models', []) if isinstance(m, dict) and m.get('id')]
+    ids += [m for m in catalog.get('available_models', []) if isinstance(m, str)]
+    default = catalog.get('default_model') or catalog.get('model')
+    if default:
+        ids = [default] + [m for m in ids if m != default]
+    # Catalog ids may carry a LiteLLM prefix; the provider's own API does not use it
+    return [m[len(provider) + 1:] if m.startswith(f"{provider}/") else m for m in ids]
+
+
+def configured_targets(providers=None, all_models=False):
+    """One target per provider (or per catalog model) that has an API key."""
+    targets = []
+    for name, (base_url, api_format, key_env) in PROVIDERS.items():
+        if providers and name not in providers:
+            continue
+        api_key = load_api_key(name, key_env)
+        models = catalog_models(name)
+        if not api_key or not models:
+            continue
+        for model in models if all_models else models[:1]:
+            targets.append({'name': f"{name}/{model}", 'base_url': base_url, 'format': api_format,
+                            'model': model, 'api_key': api_key})
+    return targets
+
+
+def load_targets(path):
+    """Targets file: a JSON list of {name, base_url, model, format, api_key | api_key_env}."""
+    with open(path) as f:
+        targets = json.load(f)
+    for target in targets:
+        target.setdefault('format', 'anthropic')
+        target.setdefault('name', f"{target['base_url']} {target['model']}")
+        if 'api_key' not in target:
+            target['api_key'] = os.environ.get(target.get('api_key_env', ''), '')
+    return targets
+
+
+def load_prompts(path):
+    """A JSON list of strings, or a text file with one prompt per line."""
+    if not path:
+        return DEFAULT_PROMPTS
+    with open(path) as f:
+        text = f.read()
+    try:
+        prompts = json.loads(text)
+    except ValueError:
+        prompts = [line.strip() for line in text.splitlines() if line.strip()]
+    return [str(p) for p in prompts]
+
+
+def start_stub_server():
+    """Serve the AntiGravity proxy's mock responses on a free local port."""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import antigravity_proxy_server as proxy
+
+    # An empty --upstream keeps the mock even when $ANTIGRAVITY_UPSTREAM is set
+    args = proxy.parse_args(['--port', '0', '--auth-dir', os.devnull, '--upstream', ''])
+    httpd = proxy.create_server(args)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    port = httpd.server_address[1]
+    target = {'name': 'stub/mock', 'base_url': f"http://127.0.0.1:{port}", 'format': 'anthropic',
+              'model': 'stub', 'api_key': 'stub'}
+    return httpd, target
+
+
+def build_request(target, prompt, max_tokens):
+    """Return (path, headers, body) for one streamed request."""
+    base_path = urllib.parse.urlsplit(target['base_url']).path.rstrip('/')
+    messages = [{'role': 'user', 'content': prompt}]
+    if target['format'] == 'openai':
+        body = {'model': target['model'], 'messages': messages, 'max_tokens': max_tokens,
+                'stream': True, 'stream_options': {'include_usage': True}}
+        headers = {'Content-Type': 'application/json', 'Authorization': f"Bearer {target['api_key']}"}
+        return f"{base_path}/chat/completions", headers, body
+    body = {'model': target['model'], 'messages': messages, 'max_tokens': max_tokens, 'stream': True}
+    headers = {'Content-Type': 'application/json', 'X-Api-Key': target['api_key'],
+               'Anthropic-Version': '2023-06-01'}
+    return f"{base_path}/v1/messages", headers, body
+
+
+def parse_stream_event(api_format, data):
+    """Return (text, output_tokens) carried by one SSE data payload."""
+    try:
+        event = json.loads(data)
+    except ValueError:
+        return '', None
+    if api_format == 'openai':
+        text = ''.join((choice.get('delta') or {}).get('content') or '' for choice in event.get('choices') or [])
+        return text, (event.get('usage') or {}).get('completion_tokens')
+    if event.get('type') == 'content_block_delta':
+        return (event.get('delta') or {}).get('text', ''), None
+    if event.get('type') == 'message_delta':
+        return '', (event.get('usage') or {}).get('output_tokens')
+    if event.get('type') == 'error':
+        raise RuntimeError((event.get('error') or {}).get('message', 'stream error'))
+    return '', None
+
+
+class Worker:
+    """Sends requests to one target over a single keep-alive connection."""
+
+    def __init__(self, target, timeout):
+        self.target = target
+        self.timeout = timeout
+        self.conn = None
+
+    def connect(self):
+        parts = urllib.parse.urlsplit(self.target['base_url'])
+        conn_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        return conn_class(parts.hostname, parts.port, timeout=self.timeout)
+
+    def run(self, prompt, max_tokens):
+        path, headers, body = build_request(self.target, prompt, max_tokens)
+        sample = {'prompt': prompt[:60], 'ok': False, 'status': None, 'ttft': None,
+                  'latency': None, 'output_tokens': None, 'tokens_per_sec': None, 'error': None}
+        started = time.monotonic()
+        first_token_at = None
+        text_parts, output_tokens = [], None
+        try:
+            if self.conn is None:
+                self.conn = self.connect()
+            self.conn.request('POST', path, body=json.dumps(body).encode(), headers=headers)
+            response = self.conn.getresponse()
+            sample['status'] = response.status
+            if response.status >= 400:
+                sample['error'] = response.read()[:300].decode('utf-8', 'replace')
+                return sample
+            for line in response:
+                line = line.strip()
+                if not line.startswith(b'data:'):
+                    continue
+                data = line[5:].strip()
+                if data == b'[DONE]':
+                    continue
+                text, tokens = parse_stream_event(self.target['format'], data)
+                if text:
+                    if first_token_at is None:
+                        first_token_at = time.monotonic()
+                    text_parts.append(text)
+                if tokens:
+                    output_tokens = tokens
+        except Exception as e:
+            # Drop the connection; the next request opens a fresh one
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+            sample['error'] = f"{type(e).__name__}: {e}"
+            return sample
+
+        finished = time.monotonic()
+        if output_tokens is None:
+            # No usage reported; about 4 characters per token
+            output_tokens = max(1, len(''.join(text_parts)) // 4) if text_parts else 0
+        sample.update(ok=True, latency=finished - started, output_tokens=output_tokens)
+        if first_token_at is not None:
+            sample['ttft'] = first_token_at - started
+            generation = finished - first_token_at
+            if generation > 0 and output_tokens:
+                sample['tokens_per_sec'] = output_tokens / generation
+        return sample
+
+
+def percentile(values, pct):
+    """Linear-interpolated percentile of a non-empty list."""
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(samples):
+    ok = [s for s in samples if s['ok']]
+    summary = {
+        'requests': len(samples),
+        'errors': len(samples) - len(ok),
+        'error_rate': (len(samples) - len(ok)) / len(samples) if samples else 0.0,
+    }
+    for key, label in (('ttft', 'ttft'), ('latency', 'latency')):
+        values = [s[key] for s in ok if s[key] is not None]
+        if values:
+            for pct in (50, 95, 99):
+                summary[f"{label}_p{pct}"] = round(percentile(values, pct), 4)
+    rates = [s['tokens_per_sec'] for s in ok if s['tokens_per_sec']]
+    if rates:
+        summary['tokens_per_sec'] = round(statistics.median(rates), 2)
+    return summary
+
+
+def bench_target(target, prompts, requests, concurrency, max_tokens, timeout):
+    """Run requests prompts against one target with up to concurrency in flight."""
+    local = threading.local()
+
+    def send(index):
+        if not hasattr(local, 'worker'):
+            local.worker = Worker(target, timeout)
+        return local.worker.run(prompts[index % len(prompts)], max_tokens)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = list(pool.map(send, range(requests)))
+    summary = summarize(samples)
+    summary['wall_time'] = round(time.monotonic() - started, 3)
+    return samples, summary
+
+
+def format_seconds(value):
+    return f"{value * 1000:.0f}ms" if value is not None else '-'
+
+
+def print_report(results):
+    print()
+    print(f"{'Target':<40} {'Req':>4} {'Err%':>6} {'TTFT p50':>9} {'p50':>8} {'p95':>8} {'p99':>8} {'tok/s':>7}")
+    print("-" * 96)
+    ranked = sorted(results, key=lambda r: (r['summary']['error_rate'],
+                                            r['summary'].get('latency_p50', float('inf'))))
+    for result in ranked:
+        s = result['summary']
+        tokens = f"{s['tokens_per_sec']:.1f}" if 'tokens_per_sec' in s else '-'
+        print(f"{result['target'][:40]:<40} {s['requests']:>4} {s['error_rate'] * 100:>5.0f}% "
+              f"{format_seconds(s.get('ttft_p50')):>9} {format_seconds(s.get('latency_p50')):>8} "
+              f"{format_seconds(s.get('latency_p95')):>8} {format_seconds(s.get('latency_p99')):>8} {tokens:>7}")
+    print()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark provider latency and throughput")
+    parser.add_argument('--providers', nargs='+', choices=sorted(PROVIDERS),
+                        help="Only these providers (default: every provider with an API key)")
+    parser.add_argument('--all-models', action='store_true',
+                        help="Benchmark every catalog model instead of each provider's default")
+    parser.add_argument('--targets', help="JSON file listing targets instead of the configured providers")
+    parser.add_argument('--stub', action='store_true',
+                        help="Benchmark the proxy's local mock server (offline testing)")
+    parser.add_argument('--prompts', help="JSON list or one-prompt-per-line file (default: built-in set)")
+    parser.add_argument('-n', '--requests', type=int, default=DEFAULT_REQUESTS,
+                        help=f"Requests per target (default: {DEFAULT_REQUESTS})")
+    parser.add_argument('-c', '--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help=f"Requests in flight per target (default: {DEFAULT_CONCURRENCY})")
+    parser.add_argument('--max-tokens', type=int, default=DEFAULT_MAX_TOKENS,
+                        help=f"max_tokens per request (default: {DEFAULT_MAX_TOKENS})")
+    parser.add_argument('--timeout', type=int, default=DEFAULT_TIMEOUT,
+                        help=f"Per-request timeout in seconds (default: {DEFAULT_TIMEOUT})")
+    parser.add_argument('-o', '--output',
+                        help=f"Where to save the JSON results (default: {RESULTS_DIR}/bench-<time>.json)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    prompts = load_prompts(args.prompts)
+
+    stub = None
+    if args.stub:
+        stub, target = start_stub_server()
+        targets = [target]
+    elif args.targets:
+        targets = load_targets(args.targets)
+    else:
+        targets = configured_targets(args.providers, args.all_models)
+
+    if not targets:
+        print("⚠️  No providers with an API key found. Save keys via claude-all, pass --targets, or use --stub.")
+        return 1
+
+    print(f"🏁 Benchmarking {len(targets)} target(s): {args.requests} requests each, "
+          f"concurrency {args.concurrency}, {len(prompts)} prompt(s)")
+    started_at = datetime.now()
+    try:
+        # Every target runs at the same time so they see the same network conditions
+        with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+            futures = [(target, pool.submit(bench_target, target, prompts, args.requests,
+                                            args.concurrency, args.max_tokens, args.timeout))
+                       for target in targets]
+            results = []
+            for target, future in futures:
+                samples, summary = future.result()
+                results.append({'target': target['name'], 'base_url': target['base_url'],
+                                'model': target['model'], 'format': target['format'],
+                                'summary': summary, 'samples': samples})
+    finally:
+        if stub is not None:
+            stub.shutdown()
+            stub.server_close()
+
+    print_report(results)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"bench-{started_at.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    report = {
+        'timestamp': started_at.isoformat(timespec='seconds'),
+        'requests_per_target': args.requests,
+        'concurrency': args.concurrency,
+        'max_tokens': args.max_tokens,
+        'prompts': prompts,
+        'results': results,
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"💾 Results saved to {output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -147,7 +147,8 @@ def main():
                     "client_secret": client_secret,
                     "access_token": token_info.get('access_token'),
                     "refresh_token": token_info.get('refresh_token', ''),
-                    "expiry_date": token_info.get('expires_in', 3600),
+                    # Absolute expiry in epoch milliseconds, as Google tooling expects
+                    "expiry_date": int((time.time() + token_info.get('expires_in', 3600)) * 1000),
                     "label": "Google Internal AntiGravity",
                     "token_uri": "https://oauth2.googleapis.com/token"
                 }
@@ -2,151 +2,726 @@
 """
 Analyze token usage from Claude Code session transcripts.
 Breaks down usage by main session and individual subagents.
+
+Accepts session files, directories (searched recursively for *.jsonl) and
+glob patterns; several files are analyzed in parallel and combined into one
+report.
+
+Only lines that can carry usage are decoded; orjson is used when installed.
+With --incremental or --follow, per-file byte offsets and totals are kept in
+a state file so each run only reads what was appended since the last one.
+
+--export writes one row per message (Parquet or Arrow IPC with pyarrow,
+otherwise CSV) and --group-by sums them by day, model, agent or session,
+vectorized with NumPy when it is installed.
+
+Costs are priced per model, with cache writes and cache reads at their own
+rates, from MODEL_PRICING, the "pricing" of model entries in the bin/*.json
+provider catalogs, and any --pricing files.
 """
 
+import argparse
+import csv
+import glob
 import json
+import mmap
+import os
 import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 from collections import defaultdict
 
-def analyze_main_session(filepath):
-    """Analyze a session file and return token usage broken down by agent."""
-    main_usage = {
-        'input_tokens': 0,
-        'output_tokens': 0,
-        'cache_creation': 0,
-        'cache_read': 0,
-        'messages': 0
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+
+# cost is what was paid; uncached_cost is what the same turns would cost without prompt caching
+USAGE_FIELDS = ('input_tokens', 'output_tokens', 'cache_creation', 'cache_read', 'messages',
+                'cost', 'uncached_cost')
+PARSERS = {'json': json.loads}
+if orjson is not None:
+    PARSERS['orjson'] = orjson.loads
+DEFAULT_PARSER = 'orjson' if orjson is not None else 'json'
+# Every line the report needs has this key; assistant lines always do
+USAGE_KEY = b'"usage"'
+STATE_FILE = os.path.expanduser("~/.cache/claude-all/token-usage-state.json")
+STATE_VERSION = 3
+DEFAULT_FOLLOW_INTERVAL = 2.0
+
+# One row per assistant message or subagent result
+ROW_COLUMNS = ('timestamp', 'session', 'agent', 'model',
+               'input_tokens', 'output_tokens', 'cache_creation', 'cache_read')
+TOKEN_COLUMNS = ROW_COLUMNS[4:]
+GROUP_KEYS = ('day', 'model', 'agent', 'session')
+ARROW_SUFFIXES = ('.arrow', '.feather', '.ipc')
+
+# $ per million tokens, matched by longest model name prefix. Anthropic bills
+# 5-minute cache writes at 1.25x and cache reads at 0.1x the input rate.
+MODEL_PRICING = {
+    'claude-opus-4-5': {'input': 5.0, 'output': 25.0, 'cache_write': 6.25, 'cache_read': 0.5},
+    'claude-opus-4': {'input': 15.0, 'output': 75.0, 'cache_write': 18.75, 'cache_read': 1.5},
+    'claude-3-opus': {'input': 15.0, 'output': 75.0, 'cache_write': 18.75, 'cache_read': 1.5},
+    'claude-sonnet-4': {'input': 3.0, 'output': 15.0, 'cache_write': 3.75, 'cache_read': 0.3},
+    'claude-3-7-sonnet': {'input': 3.0, 'output': 15.0, 'cache_write': 3.75, 'cache_read': 0.3},
+    'claude-3-5-sonnet': {'input': 3.0, 'output': 15.0, 'cache_write': 3.75, 'cache_read': 0.3},
+    'claude-haiku-4-5': {'input': 1.0, 'output': 5.0, 'cache_write': 1.25, 'cache_read': 0.1},
+    'claude-3-5-haiku': {'input': 0.8, 'output': 4.0, 'cache_write': 1.0, 'cache_read': 0.08},
+}
+DEFAULT_PRICING = {'input': 3.0, 'output': 15.0, 'cache_write': 3.75, 'cache_read': 0.3}
+PRICE_FIELDS = ('input', 'output', 'cache_write', 'cache_read')
+CATALOG_DIR = Path(__file__).resolve().parents[3] / 'bin'
+
+def iter_lines(filepath, prefilter=True, start=0, end=None):
+    """Yield the lines of a transcript worth parsing, read through a memory map.
+
+    Only the bytes from start to end (default: the end of the file) are read.
+
+    With prefilter, the whole file is searched for "usage" keys and only the
+    lines holding one are copied out and decoded: assistant messages and
+    subagent tool results. Ordinary tool output lines, which make up most of
+    a transcript, are never decoded.
+    """
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm) if end is None else min(end, len(mm))
+            if prefilter:
+                pos = mm.find(USAGE_KEY, start, size)
+                while pos != -1:
+                    line_end = mm.find(b'\n', pos, size)
+                    if line_end == -1:
+                        line_end = size
+                    yield mm[max(start, mm.rfind(b'\n', 0, pos) + 1):line_end]
+                    pos = mm.find(USAGE_KEY, line_end, size)
+                return
+            while start < size:
+                line_end = mm.find(b'\n', start, size)
+                if line_end == -1:
+                    line_end = size
+                yield mm[start:line_end]
+                start = line_end + 1
+
+def new_usage():
+    return {field: 0 for field in USAGE_FIELDS}
+
+def add_usage(totals, usage, rates):
+    """Add one API usage object, and what it cost at rates, to totals."""
+    tokens = {
+        'input_tokens': usage.get('input_tokens', 0),
+        'output_tokens': usage.get('output_tokens', 0),
+        'cache_creation': usage.get('cache_creation_input_tokens', 0),
+        'cache_read': usage.get('cache_read_input_tokens', 0),
     }
+    for name, value in tokens.items():
+        totals[name] += value
+    totals['messages'] += 1
+    totals['cost'] += calculate_cost(tokens, rates)
+    totals['uncached_cost'] += calculate_cost(tokens, uncached_rates(rates))
+
+def analyze_main_session(filepath, loads=PARSERS[DEFAULT_PARSER], prefilter=True, start=0, end=None,
+                         pricing=MODEL_PRICING, model=None):
+    """Analyze a session file and return token usage broken down by agent.
+
+    Returns (main usage, subagent usage, last model seen). model is the
+    session's model before start, when resuming part way through a file.
+    """
+    main_usage = new_usage()
 
     # Track usage per subagent
-    subagent_usage = defaultdict(lambda: {
-        'input_tokens': 0,
-        'output_tokens': 0,
-        'cache_creation': 0,
-        'cache_read': 0,
-        'messages': 0,
-        'description': None
-    })
-
-    with open(filepath, 'r') as f:
-        for line in f:
-            try:
-                data = json.loads(line)
+    subagent_usage = defaultdict(lambda: dict(new_usage(), description=None))
+
+    # Subagents run on the session's model unless their result says otherwise
+    for line in iter_lines(filepath, prefilter, start, end):
+        try:
+            data = loads(line)
 
-                # Main session assistant messages
+            # Main session assistant messages
+            if data.get('type') == 'assistant' and 'message' in data:
+                model = data['message'].get('model') or model
+                add_usage(main_usage, data['message'].get('usage', {}), model_pricing(model, pricing))
+
+            # Subagent tool results
+            if data.get('type') == 'user' and 'toolUseResult' in data:
+                result = data['toolUseResult']
+                if 'usage' in result and 'agentId' in result:
+                    agent_id = result['agentId']
+                    usage = result['usage']
+
+                    # Get description from prompt if available
+                    if subagent_usage[agent_id]['description'] is None:
+                        prompt = result.get('prompt', '')
+                        # Extract first line as description
+                        first_line = prompt.split('\n')[0] if prompt else f"agent-{agent_id}"
+                        if first_line.startswith('You are '):
+                            first_line = first_line[8:]  # Remove "You are "
+                        subagent_usage[agent_id]['description'] = first_line[:60]
+
+                    add_usage(subagent_usage[agent_id], usage, model_pricing(result.get('model') or model, pricing))
+        except:
+            pass
+
+    return main_usage, dict(subagent_usage), model
+
+def analyze_file(filepath, start=0, end=None, model=None, parser=DEFAULT_PARSER, prefilter=True,
+                 pricing=MODEL_PRICING):
+    """analyze_main_session for a worker process; unreadable files count as empty."""
+    try:
+        return analyze_main_session(filepath, PARSERS[parser], prefilter, start, end, pricing, model)
+    except OSError as e:
+        print(f"Warning: cannot read {filepath}: {e}", file=sys.stderr)
+        return new_usage(), {}, model
+
+def merge_usage(total, usage):
+    """Add one usage dict's counts into another."""
+    for field in USAGE_FIELDS:
+        total[field] += usage[field]
+
+def find_session_files(patterns):
+    """Expand files, directories and glob patterns into a sorted list of transcripts.
+
+    Subagent transcripts (agent-*.jsonl) found in directories or globs are
+    skipped: their usage is already reported in the parent session's tool
+    results, so counting them again would double it.
+    """
+    files = set()
+    for pattern in patterns:
+        path = Path(pattern)
+        if path.is_file():
+            files.add(str(path))
+            continue
+        if path.is_dir():
+            matches = path.rglob('*.jsonl')
+        else:
+            matches = (Path(match) for match in glob.glob(pattern, recursive=True))
+        files.update(str(match) for match in matches
+                     if match.is_file() and not match.name.startswith('agent-'))
+    return sorted(files)
+
+def map_files(function, files, jobs=None, *args):
+    """function(file, *per-file args) for every file, in a process pool when there are several."""
+    if not files:
+        return []
+    workers = min(jobs or os.cpu_count() or 1, len(files))
+    if workers == 1:
+        return list(map(function, files, *args))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Batches of files per task keep pickling overhead low for thousands of small transcripts
+        return list(executor.map(function, files, *args, chunksize=max(1, len(files) // (workers * 4))))
+
+def analyze_files(files, jobs=None, parser=DEFAULT_PARSER, prefilter=True, starts=None, ends=None,
+                  pricing=MODEL_PRICING, models=None):
+    """Per-file (main, subagents, last model) results, from a process pool when there are several files."""
+    starts = starts or [0] * len(files)
+    ends = ends or [None] * len(files)
+    models = models or [None] * len(files)
+    return map_files(partial(analyze_file, parser=parser, prefilter=prefilter, pricing=pricing),
+                     files, jobs, starts, ends, models)
+
+def merge_results(results, main_usage=None, subagent_usage=None):
+    """Merge per-file results into one (main, subagents) pair, optionally adding to existing totals."""
+    if main_usage is None:
+        main_usage = new_usage()
+    if subagent_usage is None:
+        subagent_usage = {}
+    for file_main, file_subagents, *_ in results:
+        merge_usage(main_usage, file_main)
+        for agent_id, usage in file_subagents.items():
+            if agent_id not in subagent_usage:
+                subagent_usage[agent_id] = dict(usage)
+            else:
+                merge_usage(subagent_usage[agent_id], usage)
+    return main_usage, subagent_usage
+
+def analyze_sessions(files, jobs=None, parser=DEFAULT_PARSER, prefilter=True, pricing=MODEL_PRICING):
+    """Analyze every file, in a process pool when there are several, and merge the results."""
+    return merge_results(analyze_files(files, jobs, parser, prefilter, pricing=pricing))
+
+def usage_rows(filepath, parser=DEFAULT_PARSER, prefilter=True):
+    """Per-message usage of one transcript, as a dict of ROW_COLUMNS lists."""
+    columns = {name: [] for name in ROW_COLUMNS}
+    loads = PARSERS[parser]
+    default_session = Path(filepath).stem
+
+    def add_row(data, agent, model, usage):
+        columns['timestamp'].append(data.get('timestamp') or '')
+        columns['session'].append(data.get('sessionId') or default_session)
+        columns['agent'].append(agent)
+        columns['model'].append(model or '')
+        columns['input_tokens'].append(usage.get('input_tokens', 0))
+        columns['output_tokens'].append(usage.get('output_tokens', 0))
+        columns['cache_creation'].append(usage.get('cache_creation_input_tokens', 0))
+        columns['cache_read'].append(usage.get('cache_read_input_tokens', 0))
+
+    # Subagent rows without a model of their own are attributed to the session's model
+    model = None
+    try:
+        for line in iter_lines(filepath, prefilter):
+            try:
+                data = loads(line)
                 if data.get('type') == 'assistant' and 'message' in data:
-                    main_usage['messages'] += 1
-                    msg_usage = data['message'].get('usage', {})
-                    main_usage['input_tokens'] += msg_usage.get('input_tokens', 0)
-                    main_usage['output_tokens'] += msg_usage.get('output_tokens', 0)
-                    main_usage['cache_creation'] += msg_usage.get('cache_creation_input_tokens', 0)
-                    main_usage['cache_read'] += msg_usage.get('cache_read_input_tokens', 0)
-
-                # Subagent tool results
+                    message = data['message']
+                    model = message.get('model') or model
+                    add_row(data, 'main', message.get('model'), message.get('usage', {}))
                 if data.get('type') == 'user' and 'toolUseResult' in data:
                     result = data['toolUseResult']
                     if 'usage' in result and 'agentId' in result:
-                        agent_id = result['agentId']
-                        usage = result['usage']
-
-                        # Get description from prompt if available
-                        if subagent_usage[agent_id]['description'] is None:
-                            prompt = result.get('prompt', '')
-                            # Extract first line as description
-                            first_line = prompt.split('\n')[0] if prompt else f"agent-{agent_id}"
-                            if first_line.startswith('You are '):
-                                first_line = first_line[8:]  # Remove "You are "
-                            subagent_usage[agent_id]['description'] = first_line[:60]
-
-                        subagent_usage[agent_id]['messages'] += 1
-                        subagent_usage[agent_id]['input_tokens'] += usage.get('input_tokens', 0)
-                        subagent_usage[agent_id]['output_tokens'] += usage.get('output_tokens', 0)
-                        subagent_usage[agent_id]['cache_creation'] += usage.get('cache_creation_input_tokens', 0)
-                        subagent_usage[agent_id]['cache_read'] += usage.get('cache_read_input_tokens', 0)
-            except:
+                        add_row(data, result['agentId'], result.get('model') or model, result['usage'])
+            except Exception:
                 pass
+    except OSError as e:
+        print(f"Warning: cannot read {filepath}: {e}", file=sys.stderr)
+    return columns
+
+def collect_rows(files, jobs=None, parser=DEFAULT_PARSER, prefilter=True):
+    """Usage rows of every file, concatenated into one dict of columns."""
+    columns = {name: [] for name in ROW_COLUMNS}
+    for file_columns in map_files(partial(usage_rows, parser=parser, prefilter=prefilter), files, jobs):
+        for name in ROW_COLUMNS:
+            columns[name].extend(file_columns[name])
+    return columns
+
+def pricing_rates(rates):
+    """Complete a pricing entry; cache rates default to the input rate (no caching discount)."""
+    input_rate = float(rates.get('input', DEFAULT_PRICING['input']))
+    return {
+        'input': input_rate,
+        'output': float(rates.get('output', DEFAULT_PRICING['output'])),
+        'cache_write': float(rates.get('cache_write', input_rate)),
+        'cache_read': float(rates.get('cache_read', input_rate)),
+    }
+
+def load_pricing(paths=()):
+    """MODEL_PRICING plus the bin/*.json catalogs' model pricing, then each --pricing file.
+
+    Catalog model entries may carry "pricing": {"input", "output",
+    "cache_write", "cache_read"} in $ per million tokens; a --pricing file
+    maps model names (or prefixes) to the same kind of object.
+    """
+    pricing = dict(MODEL_PRICING)
+    for catalog_path in sorted(CATALOG_DIR.glob('*.json')):
+        try:
+            with open(catalog_path) as f:
+                catalog = json.load(f)
+        except (OSError, ValueError):
+            continue
+        models = catalog.get('models') if isinstance(catalog, dict) else None
+        for entry in models if isinstance(models, list) else []:
+            if isinstance(entry, dict) and entry.get('id') and isinstance(entry.get('pricing'), dict):
+                pricing[entry['id'].lower()] = pricing_rates(entry['pricing'])
+    for path in paths:
+        with open(path) as f:
+            for model, rates in json.load(f).items():
+                pricing[model.lower()] = pricing_rates(rates)
+    return pricing
+
+def model_pricing(model, pricing=MODEL_PRICING):
+    """Rates for model by longest matching prefix in pricing, or DEFAULT_PRICING."""
+    model = (model or '').lower()
+    # Provider-qualified names such as anthropic/claude-sonnet-4 price like the bare model
+    model = model.rsplit('/', 1)[-1]
+    matches = [prefix for prefix in pricing if model.startswith(prefix)]
+    return pricing[max(matches, key=len)] if matches else DEFAULT_PRICING
+
+def uncached_rates(rates):
+    """Rates as if the model had no prompt cache: every input token at the input rate."""
+    return dict(rates, cache_write=rates['input'], cache_read=rates['input'])
+
+def row_costs(columns, pricing=MODEL_PRICING):
+    """Estimated cost of each row in dollars, priced by its model."""
+    models = columns['model']
+    if np is None:
+        costs = []
+        for i, model in enumerate(models):
+            usage = {name: columns[name][i] for name in TOKEN_COLUMNS}
+            costs.append(calculate_cost(usage, model_pricing(model, pricing)))
+        return costs
+    unique, inverse = np.unique(np.asarray(models, dtype=str), return_inverse=True)
+    # One row of rates per distinct model, then gathered per message
+    rates = np.array([[model_pricing(model, pricing)[field] for field in PRICE_FIELDS] for model in unique],
+                     dtype=np.float64).reshape(-1, len(PRICE_FIELDS))[inverse.reshape(-1)]
+    tokens = np.stack([np.asarray(columns[name], dtype=np.float64)
+                       for name in ('input_tokens', 'output_tokens', 'cache_creation', 'cache_read')], axis=1)
+    return (tokens * rates).sum(axis=1) / 1_000_000
+
+def key_column(columns, key):
+    if key == 'day':
+        # Timestamps are ISO 8601 in UTC, so the first ten characters are the date
+        return [timestamp[:10] for timestamp in columns['timestamp']]
+    return columns[key]
+
+def group_rows(columns, keys, pricing=MODEL_PRICING):
+    """Sum message counts, tokens and cost per distinct combination of keys.
+
+    Returns sorted (key values, totals) pairs, with totals holding 'messages',
+    TOKEN_COLUMNS and 'cost'.
+    """
+    costs = row_costs(columns, pricing)
+    if np is None:
+        groups = {}
+        for i, key in enumerate(zip(*(key_column(columns, key) for key in keys))):
+            totals = groups.setdefault(key, dict.fromkeys(('messages',) + TOKEN_COLUMNS + ('cost',), 0))
+            totals['messages'] += 1
+            for name in TOKEN_COLUMNS:
+                totals[name] += columns[name][i]
+            totals['cost'] += costs[i]
+        return sorted(groups.items())
+
+    if not columns['timestamp']:
+        return []
+    # Encode each key as integer codes, then find the distinct code combinations
+    uniques, codes = [], []
+    for key in keys:
+        values, inverse = np.unique(np.asarray(key_column(columns, key), dtype=str), return_inverse=True)
+        uniques.append(values)
+        codes.append(inverse.reshape(-1))
+    combos, group_index = np.unique(np.stack(codes, axis=1), axis=0, return_inverse=True)
+    group_index = group_index.reshape(-1)
+    count = len(combos)
+    sums = {name: np.bincount(group_index, weights=np.asarray(columns[name], dtype=np.float64), minlength=count)
+            for name in TOKEN_COLUMNS}
+    sums['messages'] = np.bincount(group_index, minlength=count)
+    sums['cost'] = np.bincount(group_index, weights=costs, minlength=count)
+
+    result = []
+    for g, combo in enumerate(combos):
+        key = tuple(str(values[code]) for values, code in zip(uniques, combo))
+        totals = {name: int(sums[name][g]) for name in ('messages',) + TOKEN_COLUMNS}
+        totals['cost'] = float(sums['cost'][g])
+        result.append((key, totals))
+    return result
+
+def export_rows(columns, path, pricing=MODEL_PRICING):
+    """Write usage rows to Parquet or Arrow IPC (by extension) or CSV; returns the path written.
+
+    Without pyarrow, Parquet and Arrow requests fall back to CSV next to the
+    requested path.
+    """
+    costs = row_costs(columns, pricing)
+    suffix = Path(path).suffix.lower()
+    if suffix == '.parquet' or suffix in ARROW_SUFFIXES:
+        if pa is not None:
+            table = arrow_table(columns, costs)
+            if suffix == '.parquet':
+                import pyarrow.parquet as pq
+                pq.write_table(table, path)
+            else:
+                with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            return path
+        path = str(Path(path).with_suffix('.csv'))
+        print(f"Warning: pyarrow is not installed; writing CSV to {path}", file=sys.stderr)
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(ROW_COLUMNS + ('cost',))
+        writer.writerows(zip(*(columns[name] for name in ROW_COLUMNS), (f"{cost:.6f}" for cost in costs)))
+    return path
+
+def arrow_table(columns, costs):
+    timestamps = pa.array([timestamp or None for timestamp in columns['timestamp']], type=pa.string())
+    arrays = {
+        'timestamp': pc.cast(timestamps, pa.timestamp('ms', tz='UTC')),
+        # Few distinct values, so dictionary encoding keeps files small
+        'session': pa.array(columns['session'], type=pa.string()).dictionary_encode(),
+        'agent': pa.array(columns['agent'], type=pa.string()).dictionary_encode(),
+        'model': pa.array(columns['model'], type=pa.string()).dictionary_encode(),
+    }
+    for name in TOKEN_COLUMNS:
+        arrays[name] = pa.array(columns[name], type=pa.int64())
+    arrays['cost'] = pa.array(costs, type=pa.float64())
+    return pa.table(arrays)
+
+def print_groups(groups, keys):
+    """Print group_rows output as a table."""
+    widths = [max([len(key)] + [len(str(group[0][i])) for group in groups]) for i, key in enumerate(keys)]
+    header = ' '.join(f"{key.capitalize():<{width}}" for key, width in zip(keys, widths))
+    line_width = len(header) + 69
+    print("-" * line_width)
+    print(f"{header} {'Msgs':>7} {'Input':>10} {'Output':>10} {'Cache W':>10} {'Cache R':>12} {'Hit':>6} {'Cost':>8}")
+    print("-" * line_width)
+    for key, totals in groups:
+        labels = ' '.join(f"{value:<{width}}" for value, width in zip(key, widths))
+        print(f"{labels} {totals['messages']:>7} "
+              f"{format_tokens(totals['input_tokens']):>10} "
+              f"{format_tokens(totals['output_tokens']):>10} "
+              f"{format_tokens(totals['cache_creation']):>10} "
+              f"{format_tokens(totals['cache_read']):>12} "
+              f"{cache_hit_ratio(totals):>6.1%} "
+              f"${totals['cost']:>7.2f}")
+    print("-" * line_width)
+
+def complete_length(filepath):
+    """Bytes up to the last newline; a line still being written is left for the next run."""
+    with open(filepath, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            block = min(end, 64 * 1024)
+            f.seek(end - block)
+            newline = f.read(block).rfind(b'\n')
+            if newline != -1:
+                return end - block + newline + 1
+            end -= block
+    return 0
 
-    return main_usage, dict(subagent_usage)
+def load_state(path):
+    """Per-file offsets and totals from earlier runs; empty if missing or unreadable."""
+    try:
+        with open(path) as f:
+            state = json.load(f)
+        if state.get('version') == STATE_VERSION:
+            return state
+    except (OSError, ValueError):
+        pass
+    return {'version': STATE_VERSION, 'files': {}}
+
+def save_state(path, state):
+    """Write the state atomically so an interrupted run never leaves it half written."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+def update_sessions(state, files, jobs=None, parser=DEFAULT_PARSER, prefilter=True, pricing=MODEL_PRICING):
+    """Read only the bytes appended to each file since the last run; returns the combined totals.
+
+    A file that got smaller or was replaced (new inode) is read again from
+    the start. Costs are stored with the totals, so earlier messages keep the
+    prices they were analyzed with; the last model seen is stored too, so
+    subagents after the resume point are priced like the session.
+    """
+    entries = state['files']
+    pending, starts, ends, models = [], [], [], []
+    for filepath in files:
+        key = os.path.abspath(filepath)
+        try:
+            inode = os.stat(filepath).st_ino
+            end = complete_length(filepath)
+        except OSError as e:
+            print(f"Warning: cannot read {filepath}: {e}", file=sys.stderr)
+            continue
+        entry = entries.get(key)
+        if entry is None or entry['inode'] != inode or entry['offset'] > end:
+            entry = entries[key] = {'inode': inode, 'offset': 0, 'model': None,
+                                    'main': new_usage(), 'subagents': {}}
+        if end > entry['offset']:
+            pending.append(filepath)
+            starts.append(entry['offset'])
+            ends.append(end)
+            models.append(entry['model'])
+
+    results = analyze_files(pending, jobs, parser, prefilter, starts, ends, pricing, models)
+    for filepath, end, result in zip(pending, ends, results):
+        entry = entries[os.path.abspath(filepath)]
+        merge_results([result], entry['main'], entry['subagents'])
+        entry['offset'] = end
+        entry['model'] = result[2]
+
+    session_entries = [entries[os.path.abspath(filepath)] for filepath in files
+                       if os.path.abspath(filepath) in entries]
+    return merge_results((entry['main'], entry['subagents']) for entry in session_entries)
+
+def run_benchmark(files, runs=3):
+    """Time full parsing against the prefilter with each available parser, on one process."""
+    total_bytes = sum(os.path.getsize(filepath) for filepath in files)
+    modes = [('json', False), ('json', True)]
+    if orjson is not None:
+        modes += [('orjson', False), ('orjson', True)]
+
+    print(f"Benchmark: {len(files)} file(s), {total_bytes / 1_000_000:,.1f} MB, best of {runs}")
+    print("-" * 60)
+    print(f"{'Parser':<10} {'Prefilter':<10} {'Seconds':>10} {'MB/s':>10} {'Speedup':>10}")
+    print("-" * 60)
+    # Warm the page cache so the first mode is not charged for disk reads
+    expected = analyze_sessions(files, jobs=1)
+    baseline = None
+    for parser, prefilter in modes:
+        best = None
+        for _ in range(runs):
+            started = time.perf_counter()
+            result = analyze_sessions(files, jobs=1, parser=parser, prefilter=prefilter)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        if result != expected:
+            print(f"Warning: {parser} with prefilter={prefilter} counted different usage", file=sys.stderr)
+        baseline = baseline or best
+        print(f"{parser:<10} {'on' if prefilter else 'off':<10} {best:>10.3f} "
+              f"{total_bytes / 1_000_000 / best:>10,.1f} {baseline / best:>9.1f}x")
+    print("-" * 60)
 
 def format_tokens(n):
     """Format token count with thousands separators."""
     return f"{n:,}"
 
-def calculate_cost(usage, input_cost_per_m=3.0, output_cost_per_m=15.0):
-    """Calculate estimated cost in dollars."""
+def calculate_cost(usage, rates=DEFAULT_PRICING):
+    """Calculate estimated cost in dollars, with cache writes and reads at their own rates."""
+    return (usage['input_tokens'] * rates['input']
+            + usage['cache_creation'] * rates['cache_write']
+            + usage['cache_read'] * rates['cache_read']
+            + usage['output_tokens'] * rates['output']) / 1_000_000
+
+def cache_hit_ratio(usage):
+    """Share of input tokens read from the prompt cache."""
     total_input = usage['input_tokens'] + usage['cache_creation'] + usage['cache_read']
-    input_cost = total_input * input_cost_per_m / 1_000_000
-    output_cost = usage['output_tokens'] * output_cost_per_m / 1_000_000
-    return input_cost + output_cost
+    return usage['cache_read'] / total_input if total_input else 0.0
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Analyze token usage from Claude Code session transcripts")
+    parser.add_argument('paths', nargs='+', metavar='path',
+                        help="Session .jsonl file, directory (e.g. ~/.claude/projects) or glob pattern")
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="Worker processes for multiple files (default: one per CPU)")
+    parser.add_argument('--parser', choices=sorted(PARSERS), default=DEFAULT_PARSER,
+                        help=f"JSON parser for transcript lines (default: {DEFAULT_PARSER})")
+    parser.add_argument('--no-prefilter', action='store_true',
+                        help="Parse every line instead of only those that can carry usage")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only read bytes appended since the last incremental run, keeping offsets "
+                             "and totals in --state-file")
+    parser.add_argument('--follow', type=float, nargs='?', const=DEFAULT_FOLLOW_INTERVAL, metavar='SECONDS',
+                        help=f"Keep watching the sessions and redraw the report as they grow "
+                             f"(implies --incremental; default every {DEFAULT_FOLLOW_INTERVAL:g}s)")
+    parser.add_argument('--state-file', default=STATE_FILE,
+                        help=f"Where --incremental and --follow keep their offsets (default: {STATE_FILE})")
+    parser.add_argument('--export', metavar='FILE',
+                        help="Write one usage row per message to FILE: .parquet or .arrow/.feather "
+                             "(needs pyarrow), otherwise CSV")
+    parser.add_argument('--group-by', metavar='KEYS',
+                        help=f"Sum usage and cost by comma-separated keys from {', '.join(GROUP_KEYS)} "
+                             f"instead of the per-agent report")
+    parser.add_argument('--pricing', action='append', default=[], metavar='FILE',
+                        help="JSON object of model name (or prefix) to $ per million tokens for input, output, "
+                             "cache_write and cache_read, overriding the built-in and bin/*.json prices "
+                             "(repeatable)")
+    parser.add_argument('--benchmark', action='store_true',
+                        help="Time each parser with and without the prefilter instead of reporting usage")
+    args = parser.parse_args()
+    args.group_by = [key.strip() for key in args.group_by.split(',')] if args.group_by else []
+    unknown = [key for key in args.group_by if key not in GROUP_KEYS]
+    if unknown:
+        parser.error(f"--group-by: unknown key {unknown[0]!r} (choose from {', '.join(GROUP_KEYS)})")
+    return args
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: analyze-token-usage.py <session-file.jsonl>")
+    args = parse_args()
+
+    session_files = find_session_files(os.path.expanduser(path) for path in args.paths)
+    if not session_files:
+        print(f"Error: Session file not found: {' '.join(args.paths)}")
         sys.exit(1)
 
-    main_session_file = sys.argv[1]
+    if args.benchmark:
+        run_benchmark(session_files)
+        return
 
-    if not Path(main_session_file).exists():
-        print(f"Error: Session file not found: {main_session_file}")
-        sys.exit(1)
+    prefilter = not args.no_prefilter
+    pricing = load_pricing(args.pricing)
+    if args.export or args.group_by:
+        columns = collect_rows(session_files, args.jobs, args.parser, prefilter)
+        if args.export:
+            path = export_rows(columns, args.export, pricing)
+            print(f"Exported {len(columns['timestamp']):,} usage rows to {path}")
+        if args.group_by:
+            print_groups(group_rows(columns, args.group_by, pricing), args.group_by)
+        return
+
+    if args.follow is not None:
+        follow_sessions(args, prefilter, pricing)
+        return
 
-    # Analyze the session
-    main_usage, subagent_usage = analyze_main_session(main_session_file)
+    # Analyze the sessions
+    if args.incremental:
+        state = load_state(args.state_file)
+        main_usage, subagent_usage = update_sessions(state, session_files, args.jobs, args.parser, prefilter,
+                                                     pricing)
+        save_state(args.state_file, state)
+    else:
+        main_usage, subagent_usage = analyze_sessions(session_files, args.jobs, args.parser, prefilter, pricing)
+    print_report(main_usage, subagent_usage, len(session_files))
 
-    print("=" * 100)
+def follow_sessions(args, prefilter, pricing=MODEL_PRICING):
+    """Re-read new bytes every few seconds and redraw the report until interrupted."""
+    state = load_state(args.state_file)
+    try:
+        while True:
+            # Directories and globs are expanded again to pick up new sessions
+            session_files = find_session_files(os.path.expanduser(path) for path in args.paths)
+            main_usage, subagent_usage = update_sessions(state, session_files, args.jobs, args.parser, prefilter,
+                                                         pricing)
+            save_state(args.state_file, state)
+            # Clear the screen and redraw from the top
+            print("\033[H\033[J", end='')
+            print_report(main_usage, subagent_usage, len(session_files))
+            print(f"Updated {time.strftime('%H:%M:%S')}, every {args.follow:g}s (Ctrl-C to stop)")
+            time.sleep(args.follow)
+    except KeyboardInterrupt:
+        print()
+
+def print_report(main_usage, subagent_usage, session_count):
+    print("=" * 120)
     print("TOKEN USAGE ANALYSIS")
-    print("=" * 100)
+    print("=" * 120)
     print()
+    if session_count > 1:
+        print(f"Session files: {session_count}")
+        print()
 
     # Print breakdown
     print("Usage Breakdown:")
-    print("-" * 100)
-    print(f"{'Agent':<15} {'Description':<35} {'Msgs':>5} {'Input':>10} {'Output':>10} {'Cache':>10} {'Cost':>8}")
-    print("-" * 100)
+    print("-" * 120)
+    print(f"{'Agent':<15} {'Description':<35} {'Msgs':>5} {'Input':>9} {'Output':>9} {'Cache W':>9} "
+          f"{'Cache R':>9} {'Hit':>6} {'Cost':>8} {'$/turn':>7}")
+    print("-" * 120)
+
+    def print_row(agent, desc, usage):
+        per_turn = usage['cost'] / usage['messages'] if usage['messages'] else 0.0
+        print(f"{agent:<15} {desc:<35} "
+              f"{usage['messages']:>5} "
+              f"{format_tokens(usage['input_tokens']):>9} "
+              f"{format_tokens(usage['output_tokens']):>9} "
+              f"{format_tokens(usage['cache_creation']):>9} "
+              f"{format_tokens(usage['cache_read']):>9} "
+              f"{cache_hit_ratio(usage):>6.1%} "
+              f"${usage['cost']:>7.2f} "
+              f"${per_turn:>6.3f}")
 
     # Main session
-    cost = calculate_cost(main_usage)
-    print(f"{'main':<15} {'Main session (coordinator)':<35} "
-          f"{main_usage['messages']:>5} "
-          f"{format_tokens(main_usage['input_tokens']):>10} "
-          f"{format_tokens(main_usage['output_tokens']):>10} "
-          f"{format_tokens(main_usage['cache_read']):>10} "
-          f"${cost:>7.2f}")
+    main_desc = 'Main session (coordinator)' if session_count == 1 else 'Main sessions (coordinators)'
+    print_row('main', main_desc, main_usage)
 
     # Subagents (sorted by agent ID)
     for agent_id in sorted(subagent_usage.keys()):
         usage = subagent_usage[agent_id]
-        cost = calculate_cost(usage)
-        desc = usage['description'] or f"agent-{agent_id}"
-        print(f"{agent_id:<15} {desc:<35} "
-              f"{usage['messages']:>5} "
-              f"{format_tokens(usage['input_tokens']):>10} "
-              f"{format_tokens(usage['output_tokens']):>10} "
-              f"{format_tokens(usage['cache_read']):>10} "
-              f"${cost:>7.2f}")
+        print_row(agent_id, usage['description'] or f"agent-{agent_id}", usage)
 
-    print("-" * 100)
+    print("-" * 120)
 
     # Calculate totals
-    total_usage = {
-        'input_tokens': main_usage['input_tokens'],
-        'output_tokens': main_usage['output_tokens'],
-        'cache_creation': main_usage['cache_creation'],
-        'cache_read': main_usage['cache_read'],
-        'messages': main_usage['messages']
-    }
-
+    total_usage = dict(main_usage)
     for usage in subagent_usage.values():
-        total_usage['input_tokens'] += usage['input_tokens']
-        total_usage['output_tokens'] += usage['output_tokens']
-        total_usage['cache_creation'] += usage['cache_creation']
-        total_usage['cache_read'] += usage['cache_read']
-        total_usage['messages'] += usage['messages']
+        merge_usage(total_usage, usage)
 
     total_input = total_usage['input_tokens'] + total_usage['cache_creation'] + total_usage['cache_read']
     total_tokens = total_input + total_usage['output_tokens']
-    total_cost = calculate_cost(total_usage)
+    total_cost = total_usage['cost']
+    saved = total_usage['uncached_cost'] - total_cost
+    per_turn = total_cost / total_usage['messages'] if total_usage['messages'] else 0.0
 
     print()
     print("TOTALS:")
@@ -158,11 +733,13 @@ def main():
     print()
     print(f"  Total input (incl cache): {format_tokens(total_input)}")
     print(f"  Total tokens:             {format_tokens(total_tokens)}")
+    print(f"  Cache hit ratio:          {cache_hit_ratio(total_usage):.1%} of input read from cache")
     print()
-    print(f"  Estimated cost: ${total_cost:.2f}")
-    print("  (at $3/$15 per M tokens for input/output)")
+    print(f"  Estimated cost: ${total_cost:.2f} (${per_turn:.3f} per turn)")
+    print(f"  Without caching: ${total_usage['uncached_cost']:.2f} (caching saved ${saved:.2f})")
+    print("  (at each model's input/output/cache write/cache read price per M tokens)")
     print()
-    print("=" * 100)
+    print("=" * 120)
 
 if __name__ == '__main__':
     main()